@@ -0,0 +1,167 @@
+"""
+admission.py
+Контроль допуска запросов к веб-серверу вебхуков (index.start_webserver).
+У каждого маршрута свой лимит одновременных обработчиков и своя очередь
+ожидания: поток /new_order занимает только свои слоты, и уведомления
+об оплате (/payment-notification) не ждут за ним. Когда очередь маршрута
+полна, запрос сразу получает 503 с Retry-After, а не копится в памяти;
+тело больше max_body отклоняется с 413: по Content-Length — до чтения,
+без него (chunked) — как только прочитано больше max_body. Потоковые
+обработчики читают тело через body_stream(request).
+"""
+
+import asyncio
+import logging
+import math
+import time
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Ключ запроса, под которым middleware кладёт LimitedStream
+BODY_STREAM = "admission.body_stream"
+
+
+class LimitedStream:
+    """
+    Обёртка над request.content, которая считает прочитанные байты и
+    бросает HTTPRequestEntityTooLarge, как только их больше max_size.
+    Поддерживает то, чем читают тело обработчики: построчную итерацию,
+    iter_chunked(), readany() и readline().
+    """
+
+    def __init__(self, stream, max_size):
+        self._stream = stream
+        self.max_size = max_size
+        self.size = 0
+
+    def _count(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise web.HTTPRequestEntityTooLarge(max_size=self.max_size, actual_size=self.size)
+        return data
+
+    async def readany(self):
+        return self._count(await self._stream.readany())
+
+    async def readline(self):
+        return self._count(await self._stream.readline())
+
+    async def iter_chunked(self, size):
+        while True:
+            chunk = await self._stream.read(size)
+            if not chunk:
+                return
+            yield self._count(chunk)
+
+    async def _lines(self):
+        while True:
+            line = await self.readline()
+            if not line:
+                return
+            yield line
+
+    def __aiter__(self):
+        return self._lines()
+
+
+def body_stream(request):
+    """
+    Тело запроса для потокового чтения: с лимитом маршрута, если он задан.
+    """
+    return request.get(BODY_STREAM, request.content)
+
+
+class RouteLimit:
+    """
+    Лимиты одного маршрута: concurrency обработчиков одновременно, до queue
+    запросов в ожидании, тело не больше max_body байт (None — без проверки).
+    """
+
+    def __init__(self, concurrency, queue, max_body=None):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.max_body = max_body
+        self.active = 0
+        self.waiting = 0
+        self.avg_ms = 0.0
+        self._slots = asyncio.Semaphore(concurrency)
+        self.stats = {"admitted": 0, "queued": 0, "shed": 0, "too_large": 0, "max_waiting": 0}
+
+    def retry_after(self):
+        """
+        Оценка в секундах, когда освободится место: очередь, делённая
+        на пропускную способность по среднему времени обработки.
+        """
+        per_second = self.concurrency / max(self.avg_ms / 1000, 0.001)
+        return max(1, math.ceil((self.waiting + 1) / per_second))
+
+    def observe(self, elapsed_ms):
+        # скользящее среднее, чтобы оценка следовала за текущей нагрузкой
+        self.avg_ms = elapsed_ms if not self.avg_ms else self.avg_ms * 0.9 + elapsed_ms * 0.1
+
+    def as_dict(self):
+        return {**self.stats, "active": self.active, "waiting": self.waiting,
+                "avg_ms": round(self.avg_ms, 2)}
+
+
+class AdmissionControl:
+    """
+    Middleware aiohttp. limits — {путь: RouteLimit}; запросы к остальным
+    путям проходят через общий default.
+    """
+
+    def __init__(self, limits, default):
+        self.limits = limits
+        self.default = default
+
+    def limit_for(self, path):
+        return self.limits.get(path, self.default)
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        limit = self.limit_for(request.path)
+        if limit.max_body is not None and (request.content_length or 0) > limit.max_body:
+            limit.stats["too_large"] += 1
+            logger.warning("Rejected %s: body of %s bytes", request.path, request.content_length)
+            return web.json_response({"error": "Request body too large"}, status=413)
+        if limit.max_body is not None:
+            # chunked-запрос не сообщает размер заранее: request.read()/json()
+            # ограничивает client_max_size, потоковое чтение — LimitedStream
+            request = request.clone(client_max_size=limit.max_body)
+            request[BODY_STREAM] = LimitedStream(request.content, limit.max_body)
+        if limit._slots.locked():
+            if limit.waiting >= limit.queue:
+                limit.stats["shed"] += 1
+                return web.json_response({"error": "Overloaded"}, status=503,
+                                         headers={"Retry-After": str(limit.retry_after())})
+            limit.stats["queued"] += 1
+            limit.stats["max_waiting"] = max(limit.stats["max_waiting"], limit.waiting + 1)
+        limit.waiting += 1
+        try:
+            await limit._slots.acquire()
+        finally:
+            limit.waiting -= 1
+        limit.active += 1
+        limit.stats["admitted"] += 1
+        started = time.perf_counter()
+        try:
+            try:
+                response = await handler(request)
+            except web.HTTPRequestEntityTooLarge:
+                response = web.json_response({"error": "Request body too large"}, status=413)
+            # 413 может вернуть и сам обработчик, приняв уже прочитанную часть тела
+            if response.status == 413:
+                limit.stats["too_large"] += 1
+                logger.warning("Rejected %s: body over %s bytes", request.path, limit.max_body)
+            return response
+        finally:
+            limit.observe((time.perf_counter() - started) * 1000)
+            limit.active -= 1
+            limit._slots.release()
+
+    def metrics(self):
+        routes = {path: limit.as_dict() for path, limit in self.limits.items()}
+        routes["*"] = self.default.as_dict()
+        return routes
@@ -0,0 +1,298 @@
+"""
+bench.py
+Нагрузочные замеры для слоя данных бота. Запуск:
+    python bench.py loop_lag [--updates 2000]
+    python bench.py match [--users 200000]
+    python bench.py search [--orders 1000000]
+    python bench.py orders_memory [--orders 1000000]
+Все замеры работают на временной БД и не трогают bot.db.
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import db
+import matcher
+import migrations
+from orders import Order
+
+
+def _use_temp_db():
+    db.close_connections()
+    db.subscription_index.reset()
+    db.DATABASE = os.path.join(tempfile.mkdtemp(prefix="bench_"), "bench.db")
+    db.init_db()
+    migrations.run_migrations()
+    return db.DATABASE
+
+
+def _report(name, samples_ms):
+    samples_ms = sorted(samples_ms)
+    p99 = samples_ms[min(len(samples_ms) - 1, int(len(samples_ms) * 0.99))]
+    print(f"{name:<28} mean={statistics.fmean(samples_ms):8.3f} ms  "
+          f"p99={p99:8.3f} ms  max={samples_ms[-1]:8.3f} ms")
+
+
+# ---------------------------------------------------------------------------
+# loop_lag: задержка event loop при конкурентных апдейтах
+# ---------------------------------------------------------------------------
+
+async def _measure_lag(stop, samples, interval=0.001):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append((loop.time() - started - interval) * 1000)
+
+
+def _sync_update(tg_id):
+    user_id = db.get_user_by_telegram_id(tg_id)[0]
+    db.get_notification_items(user_id, "city")
+    db.toggle_notification_item(user_id, "city", "Москва")
+    db.add_request(user_id, "Продажа", "Медь", "1 т", "Москва", "bench")
+
+
+async def _async_update(tg_id):
+    import db_async
+    user_id = (await db_async.get_user_by_telegram_id(tg_id))[0]
+    await db_async.get_notification_items(user_id, "city")
+    await db_async.toggle_notification_item(user_id, "city", "Москва")
+    await db_async.add_request(user_id, "Продажа", "Медь", "1 т", "Москва", "bench")
+
+
+async def _run_updates(updates, users, use_async):
+    samples = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(_measure_lag(stop, samples))
+    await asyncio.sleep(0)
+
+    async def one(i):
+        tg_id = 1_000_000 + i % users
+        if use_async:
+            await _async_update(tg_id)
+        else:
+            _sync_update(tg_id)
+            await asyncio.sleep(0)
+
+    await asyncio.gather(*(one(i) for i in range(updates)))
+    stop.set()
+    await monitor
+    return samples
+
+
+def bench_loop_lag(updates, users=200):
+    _use_temp_db()
+    for i in range(users):
+        db.add_user(1_000_000 + i, f"bench{i}")
+
+    print(f"loop_lag: {updates} concurrent updates over {users} users")
+    started = time.perf_counter()
+    samples = asyncio.run(_run_updates(updates, users, use_async=False))
+    print(f"  sync sqlite on event loop: {time.perf_counter() - started:.2f} s total")
+    _report("  loop lag (sync db)", samples)
+
+    started = time.perf_counter()
+    samples = asyncio.run(_run_updates(updates, users, use_async=True))
+    print(f"  db_async executor:         {time.perf_counter() - started:.2f} s total")
+    _report("  loop lag (db_async)", samples)
+
+
+# ---------------------------------------------------------------------------
+# match: подбор получателей — SQL против индексов в памяти
+# ---------------------------------------------------------------------------
+
+MATCH_SQL = '''
+    SELECT id
+    FROM users u
+    WHERE NOT EXISTS (
+        SELECT 1 FROM notification_filters f
+        WHERE f.user_id = u.id AND f.is_enabled = 0
+          AND ((f.filter_type = 'material' AND f.value = ?)
+               OR (f.filter_type = 'city' AND f.value = ?))
+    )
+    ORDER BY id
+'''
+
+
+def _time_ms(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def bench_match(users, per_user=10, values=50, repeat=20):
+    import random
+    import tracemalloc
+
+    path = _use_temp_db()
+    rng = random.Random(42)
+    print(f"match: {users} users, each disabled {per_user} materials + {per_user} cities (of {values} each)")
+    with db.transaction() as cursor:
+        cursor.executemany("INSERT INTO users (id, telegram_id, username) VALUES (?, ?, ?)",
+                           ((uid, uid, None) for uid in range(1, users + 1)))
+        for filter_type, prefix in (("material", "Материал"), ("city", "Город")):
+            cursor.executemany(
+                "INSERT INTO notification_filters (user_id, filter_type, value, is_enabled) VALUES (?, ?, ?, 0)",
+                ((uid, filter_type, f"{prefix} {v}")
+                 for uid in range(1, users + 1)
+                 for v in rng.sample(range(1, values + 1), per_user)))
+    db.get_connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    print(f"  sqlite file: {os.path.getsize(path) / 2**20:8.1f} MiB")
+
+    snapshot = db._fetch_subscriptions()
+    indexes = {}
+    for backend in ("sets", "bitset"):
+        tracemalloc.start()
+        index = matcher.create_index(backend)
+        index.load(lambda: snapshot)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        indexes[backend] = index
+        print(f"  {backend:<6} index: {size / 2**20:8.1f} MiB")
+    del snapshot
+
+    material, city = "Материал 7", "Город 13"
+    expected = [r[0] for r in db.get_connection().execute(MATCH_SQL, (material, city))]
+    print(f"  matches for ({material}, {city}): {len(expected)}")
+    _report("  SQL query", _time_ms(
+        lambda: db.get_connection().execute(MATCH_SQL, (material, city)).fetchall(), max(3, repeat // 5)))
+    for backend, index in indexes.items():
+        assert index.match(material, city) == expected
+        _report(f"  {backend} match", _time_ms(lambda: index.match(material, city), repeat))
+    bitset = indexes["bitset"]
+    _report("  bitset AND only", _time_ms(
+        lambda: bitset._all & ~(bitset._bitmaps["material"][material] | bitset._bitmaps["city"][city]), repeat))
+
+
+# ---------------------------------------------------------------------------
+# search: поиск по заказам — перебор подстрок против FTS5 trigram
+# ---------------------------------------------------------------------------
+
+BENCH_MATERIALS = ["Медь блестящая", "Медь кусковая", "Латунь", "Бронза", "Алюминий электротехнический",
+                   "Алюминиевая банка", "Нержавейка 12Х18Н10Т", "Свинец аккумуляторный", "Цинк", "Титан ВТ1-0",
+                   "Никель", "Твердый сплав ВК8", "Магний", "Олово", "Кабель медный", "Лом черных металлов 3А",
+                   "Чугун", "Радиодетали", "Катализаторы", "Аккумуляторы АКБ"]
+BENCH_CITIES = ["Москва", "Санкт-Петербург", "Екатеринбург", "Новосибирск", "Казань", "Нижний Новгород",
+                "Челябинск", "Самара", "Омск", "Ростов-на-Дону", "Уфа", "Красноярск", "Пермь", "Воронеж",
+                "Волгоград", "Краснодар", "Тюмень", "Иркутск", "Хабаровск", "Владивосток"]
+BENCH_COMMENTS = ["самовывоз", "нужна доставка", "оплата наличными", "звонить после 18:00",
+                  "безнал с НДС", "срочно", "регулярные объёмы", "фото по запросу", ""]
+
+
+def _bench_orders(count, seed=7):
+    import random
+    rng = random.Random(seed)
+    for order_id in range(1, count + 1):
+        yield {
+            "order_id": order_id,
+            "text_material": rng.choice(BENCH_MATERIALS),
+            "text_volume": f"{rng.randint(1, 500)} т",
+            "text_city": rng.choice(BENCH_CITIES),
+            "comment": rng.choice(BENCH_COMMENTS),
+            "date": f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        }
+
+
+def _scan_search(rows, search, page_size=10):
+    # прежний поиск build_requests_page_text: lower() каждого поля на каждый запрос
+    search_lower = search.lower()
+    found = [r for r in rows if any(search_lower in str(field).lower() for field in r)]
+    return found[:page_size]
+
+
+def bench_search(orders, repeat=5, chunk=50_000):
+    from itertools import islice
+
+    path = _use_temp_db()
+    print(f"search: {orders} orders")
+    started = time.perf_counter()
+    source = _bench_orders(orders)
+    while True:
+        batch = list(islice(source, chunk))
+        if not batch:
+            break
+        db.upsert_orders([Order.from_api(o) for o in batch])
+    db.get_connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    print(f"  ingest + FTS5 index: {time.perf_counter() - started:6.1f} s, "
+          f"file {os.path.getsize(path) / 2**20:.0f} MiB")
+
+    rows = [(o["order_id"], "Новая заявка", o["text_material"], o["text_volume"],
+             o["text_city"], o["comment"], o["date"]) for o in _bench_orders(orders)]
+    for query in ("медь", "екатеринбург", "ВТ1", "звонить после", "ме"):
+        found = db.search_orders(query)[0]
+        print(f"  '{query}': first page {len(found)} rows")
+        _report("    python scan", _time_ms(lambda: _scan_search(rows, query), max(1, repeat // 2)))
+        _report("    search_orders p1", _time_ms(lambda: db.search_orders(query), repeat))
+        next_cursor = db.search_orders(query)[2]
+        if next_cursor:
+            _report("    search_orders p2", _time_ms(lambda: db.search_orders(query, next_cursor), repeat))
+
+
+def _traced_mib(build):
+    import gc
+    import tracemalloc
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size / 2**20
+
+
+def bench_orders_memory(orders, repeat=3):
+    print(f"orders_memory: {orders} orders")
+    import json
+    # как после json.loads ответа API: у каждого заказа свои объекты строк
+    feed = [json.dumps(o, ensure_ascii=False) for o in _bench_orders(orders)]
+    dicts, dicts_mib = _traced_mib(lambda: [json.loads(line) for line in feed])
+    print(f"  API dicts:            {dicts_mib:7.1f} MiB  ({dicts_mib * 2**20 / orders:5.0f} B/order)")
+    tuples, tuples_mib = _traced_mib(lambda: [
+        (o["order_id"], "Новая заявка", o["text_material"], o["text_volume"],
+         o["text_city"], o["comment"], o["date"]) for o in dicts])
+    print(f"  7-tuples over dicts:  {tuples_mib:7.1f} MiB  (сверх словарей)")
+    del dicts
+    records, records_mib = _traced_mib(lambda: [Order.from_api(json.loads(line)) for line in feed])
+    print(f"  Order records:        {records_mib:7.1f} MiB  ({records_mib * 2**20 / orders:5.0f} B/order, "
+          f"с search_key)")
+    for query in ("медь", "ме"):
+        _report(f"  '{query}' lower() per field", _time_ms(lambda: _scan_search(tuples, query), repeat))
+        _report(f"  '{query}' search_key", _time_ms(
+            lambda: [o for o in records if query in o.search_key][:10], repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("loop_lag", help="задержка event loop: sync db против db_async")
+    p.add_argument("--updates", type=int, default=2000)
+
+    p = sub.add_parser("match", help="подбор получателей: SQL против индексов в памяти")
+    p.add_argument("--users", type=int, default=200_000)
+
+    p = sub.add_parser("search", help="поиск по заказам: перебор против FTS5")
+    p.add_argument("--orders", type=int, default=1_000_000)
+
+    p = sub.add_parser("orders_memory", help="память и поиск: словари и кортежи против Order")
+    p.add_argument("--orders", type=int, default=1_000_000)
+
+    args = parser.parse_args()
+    if args.bench == "loop_lag":
+        bench_loop_lag(args.updates)
+    elif args.bench == "match":
+        bench_match(args.users)
+    elif args.bench == "search":
+        bench_search(args.orders)
+    elif args.bench == "orders_memory":
+        bench_orders_memory(args.orders)
+
+
+if __name__ == "__main__":
+    main()
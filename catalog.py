@@ -0,0 +1,160 @@
+"""
+catalog.py
+Кэш каталога материалов и городов Scraptraffic. Каталог меняется редко,
+поэтому клавиатуры фильтров строятся из памяти: после истечения TTL
+вызывающий сразу получает прежнюю (устаревшую) версию, а обновление идёт
+в фоне условным запросом (If-None-Match / If-Modified-Since), так что
+неизменившийся каталог не скачивается заново (304). Прогрев — в index.start_bot.
+С каждой новой версией каталога перестраиваются normalizer
+(normalize.CatalogNormalizer) для приведения названий из заказов и
+categories (taxonomy.classify) — число материалов в каждой категории
+для меню подписок. Города каталога без координат в geo.CITY_COORDINATES
+(заявки из них подписки по радиусу не ограничивают) пишутся в лог
+и видны в /test/upstream_metrics, чтобы таблицу можно было дополнить.
+"""
+
+import asyncio
+import logging
+import time
+
+import upstream
+from config import CATALOG_TTL
+from geo import geo_index
+from normalize import CatalogNormalizer
+from taxonomy import classify
+
+logger = logging.getLogger(__name__)
+
+
+def parse_catalog(raw_data):
+    """
+    Ответ materials_and_cities → {"materials": [...], "cities": [...]} (названия).
+    """
+    materials_list = [m["title"] for m in raw_data.get("materials", [])
+                      if isinstance(m, dict) and "title" in m]
+    cities_list = [c["title"] for c in raw_data.get("cities", [])
+                   if isinstance(c, dict) and "title" in c]
+    return {"materials": materials_list, "cities": cities_list}
+
+
+class CatalogCache:
+    """
+    Каталог в памяти с TTL и обновлением по принципу stale-while-revalidate.
+    Пока идёт обновление, остальные вызовы не запускают второе, а ждут
+    его результата (или сразу берут прежнюю версию); такие вызовы
+    считаются в stats["coalesced"].
+    """
+
+    def __init__(self, ttl=CATALOG_TTL, endpoint="materials_and_cities"):
+        self.ttl = ttl
+        self.endpoint = endpoint
+        self._data = None
+        self._fetched_at = 0.0
+        self._etag = None
+        self._last_modified = None
+        self._refreshing = None
+        self.normalizer = CatalogNormalizer()
+        self.categories = {}
+        self.unlocated_cities = []
+        self.stats = {"hits": 0, "stale": 0, "refreshes": 0, "not_modified": 0, "errors": 0,
+                      "coalesced": 0}
+
+    def is_fresh(self):
+        return self._data is not None and time.monotonic() - self._fetched_at < self.ttl
+
+    async def get(self):
+        """
+        Возвращает каталог. Ждёт сеть только если каталога ещё нет вовсе.
+        """
+        if self._data is None:
+            return await self.refresh()
+        if self.is_fresh():
+            self.stats["hits"] += 1
+        else:
+            self.stats["stale"] += 1
+            self._start_refresh()
+        return self._data
+
+    def _start_refresh(self):
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.ensure_future(self._revalidate())
+            self._refreshing.add_done_callback(self._log_failure)
+        else:
+            # запрос за тем же каталогом уже идёт — второй в сеть не уходит
+            self.stats["coalesced"] += 1
+        return self._refreshing
+
+    @staticmethod
+    def _log_failure(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Catalog refresh failed, serving stale data: %s", task.exception())
+
+    async def refresh(self):
+        """
+        Обновляет каталог (или присоединяется к уже идущему обновлению).
+        """
+        return await asyncio.shield(self._start_refresh())
+
+    async def _revalidate(self):
+        headers = {}
+        if self._data is not None:
+            if self._etag:
+                headers["If-None-Match"] = self._etag
+            if self._last_modified:
+                headers["If-Modified-Since"] = self._last_modified
+        try:
+            async with upstream.client.request("GET", self.endpoint, headers=headers) as resp:
+                if resp.status == 304 and self._data is not None:
+                    self.stats["not_modified"] += 1
+                else:
+                    resp.raise_for_status()
+                    self._data = parse_catalog(await resp.json())
+                    # индекс опечаток строится заметное время — не в event loop
+                    self.normalizer = await asyncio.to_thread(CatalogNormalizer, self._data)
+                    self.categories = classify(self._data["materials"])
+                    self.unlocated_cities = geo_index.missing(self._data["cities"])
+                    if self.unlocated_cities:
+                        logger.warning("Catalog cities without coordinates, not limited by radius "
+                                       "subscriptions: %s of %s: %s", len(self.unlocated_cities),
+                                       len(self._data["cities"]), ", ".join(self.unlocated_cities))
+                    self._etag = resp.headers.get("ETag")
+                    self._last_modified = resp.headers.get("Last-Modified")
+                    self.stats["refreshes"] += 1
+                    logger.info("Catalog refreshed: %s materials, %s cities",
+                                len(self._data["materials"]), len(self._data["cities"]))
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        self._fetched_at = time.monotonic()
+        return self._data
+
+    async def warm_up(self):
+        """
+        Загружает каталог при старте; ошибка не мешает запуску бота —
+        каталог подгрузится при первом обращении.
+        """
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.error("Catalog warm-up failed: %s", e)
+
+    async def get_normalizer(self):
+        """
+        Нормализатор по текущему каталогу. Если каталог недоступен,
+        возвращается прежний (или пустой, только сворачивающий пробелы).
+        """
+        try:
+            await self.get()
+        except Exception as e:
+            logger.error("Catalog unavailable for normalization: %s", e)
+        return self.normalizer
+
+    def metrics(self):
+        return {**self.stats, "cities": len(self._data["cities"]) if self._data else 0,
+                "unlocated_cities": self.unlocated_cities}
+
+    def invalidate(self):
+        self._fetched_at = 0.0
+
+
+cache = CatalogCache()
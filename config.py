@@ -11,3 +11,31 @@ load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
 BEARER_TOKEN = os.getenv("BEARER_TOKEN")
+
+# Индекс подписок в памяти: "bitset" (битовые карты) или "sets" (множества)
+MATCHER_BACKEND = os.getenv("MATCHER_BACKEND", "bitset")
+
+# Сколько секунд каталог материалов и городов считается свежим (catalog.py)
+CATALOG_TTL = int(os.getenv("CATALOG_TTL", "600"))
+
+# Период фоновой синхронизации локальной копии заказов, секунды (order_sync.py)
+ORDERS_SYNC_INTERVAL = int(os.getenv("ORDERS_SYNC_INTERVAL", "60"))
+
+# Задержка уведомлений о заявках по типу аккаунта, секунды (db.enqueue_notifications):
+# Pro — мгновенно, бесплатный — ≈15 мин
+DELIVERY_DELAYS = {
+    "pro": 0,
+    "free": int(os.getenv("FREE_DELIVERY_DELAY", "900")),
+}
+
+# Окно дайджеста по типу аккаунта, секунды: заявки за окно приходят одним
+# сообщением (db.enqueue_notifications); 0 — каждая заявка отдельно
+DIGEST_WINDOWS = {
+    "pro": 0,
+    "free": int(os.getenv("FREE_DIGEST_WINDOW", "900")),
+}
+
+# Защита от повторной доставки заказа (db.remember_order_keys): сколько секунд
+# помнить ключ принятого заказа и сколько ключей хранить не больше
+ORDER_DEDUP_TTL = int(os.getenv("ORDER_DEDUP_TTL", "86400"))
+ORDER_DEDUP_MAX_KEYS = int(os.getenv("ORDER_DEDUP_MAX_KEYS", "100000"))
@@ -4,101 +4,224 @@ db.py
 """
 
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from config import (DELIVERY_DELAYS, DIGEST_WINDOWS, MATCHER_BACKEND,
+                    ORDER_DEDUP_MAX_KEYS, ORDER_DEDUP_TTL)
+from geo import MAX_RADIUS_KM, format_radius, geo_index
+from matcher import create_index
+from orders import Order
 
 DATABASE = 'bot.db'
 
-def init_db():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
+# PRAGMA, которые выставляются один раз при открытии соединения.
+# WAL позволяет читателям не блокировать писателя, synchronous=NORMAL
+# в режиме WAL делает fsync только на чекпоинтах.
+PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("cache_size", -16000),        # ~16 МБ страничного кэша
+    ("mmap_size", 128 * 1024 * 1024),
+    ("temp_store", "MEMORY"),
+    ("busy_timeout", 5000),
+)
 
-    # Таблица пользователей
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            telegram_id INTEGER UNIQUE,
-            username TEXT,
-            role TEXT DEFAULT 'buyer',
-            account_type TEXT DEFAULT 'free',
-            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+# Соединения живут всё время работы потока: по одному на поток.
+# Все asyncio-задачи одного event loop работают в одном потоке и
+# разделяют его соединение — это безопасно, т.к. внутри транзакции
+# нет await. Соединения завершившихся потоков закрываются при открытии
+# следующего, так что короткоживущие потоки (Flask в server.py) их не копят.
+_local = threading.local()
+_connections = {}  # поток → соединение
+_connections_lock = threading.Lock()
+_generation = 0
 
-    # Таблица user_preferences (опционально, если нужно)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_preferences (
-            id INTEGER PRIMARY KEY,
-            user_id INTEGER,
-            city_preferences TEXT,
-            metal_preferences TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-    ''')
+# Индекс подписок в памяти для get_users_for_notification.
+# Загружается лениво при первом подборе получателей.
+subscription_index = create_index(MATCHER_BACKEND)
 
-    # Таблица заявок
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS requests (
-            id INTEGER PRIMARY KEY,
-            user_id INTEGER,
-            req_type TEXT,
-            material TEXT,
-            quantity TEXT,
-            city TEXT,
-            info TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-    ''')
 
-    # Таблица фильтров уведомлений (города/материалы)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS notification_filters (
-            id INTEGER PRIMARY KEY,
-            user_id INTEGER,
-            filter_type TEXT,  -- "material" или "city"
-            value TEXT,        -- например "Материал 1" или "Город 5"
-            is_enabled INTEGER DEFAULT 1,
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-    ''')
+def _casefold(value):
+    return value.casefold() if isinstance(value, str) else value
+
+
+def _open_connection(path):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    for name, value in PRAGMAS:
+        conn.execute(f"PRAGMA {name}={value}")
+    # встроенный lower() в SQLite понимает только ASCII
+    conn.create_function("casefold", 1, _casefold, deterministic=True)
+    current = threading.current_thread()
+    with _connections_lock:
+        stale = [thread for thread in _connections if thread is current or not thread.is_alive()]
+        stale = [_connections.pop(thread) for thread in stale]
+        _connections[current] = conn
+    for old in stale:
+        try:
+            old.close()
+        except sqlite3.Error:
+            pass
+    return conn
 
-    conn.commit()
-    conn.close()
 
 def get_connection():
-    return sqlite3.connect(DATABASE)
+    """
+    Возвращает долгоживущее соединение текущего потока (создаёт при первом вызове).
+    Закрывать его не нужно — используйте transaction().
+    """
+    conn = getattr(_local, "conn", None)
+    if (conn is None or getattr(_local, "path", None) != DATABASE
+            or getattr(_local, "generation", None) != _generation):
+        conn = _open_connection(DATABASE)
+        _local.conn = conn
+        _local.path = DATABASE
+        _local.generation = _generation
+        _local.depth = 0
+    return conn
 
-def add_user(telegram_id, username, role='buyer', account_type='free'):
+
+@contextmanager
+def transaction():
+    """
+    Контекстный менеджер транзакции: отдаёт курсор, на выходе делает commit,
+    при исключении — rollback. Вложенные вызовы присоединяются к внешней транзакции.
+    """
     conn = get_connection()
+    depth = _local.depth
+    _local.depth = depth + 1
     cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR IGNORE INTO users (telegram_id, username, role, account_type)
-        VALUES (?, ?, ?, ?)
-    ''', (telegram_id, username, role, account_type))
-    conn.commit()
-    conn.close()
+    try:
+        yield cursor
+        if depth == 0:
+            conn.commit()
+    except BaseException:
+        if depth == 0:
+            conn.rollback()
+        raise
+    finally:
+        _local.depth = depth
+        cursor.close()
+
+
+def close_thread_connection():
+    """
+    Закрывает соединение текущего потока, если оно открыто. Для потоков,
+    которые живут один запрос (server.py), чтобы не ждать следующей уборки.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        return
+    _local.conn = None
+    with _connections_lock:
+        if _connections.get(threading.current_thread()) is conn:
+            del _connections[threading.current_thread()]
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+
+def close_connections():
+    """
+    Закрывает все открытые соединения (вызывается при остановке процесса).
+    """
+    global _generation
+    with _connections_lock:
+        conns = list(_connections.values())
+        _connections.clear()
+        _generation += 1
+    for conn in conns:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+def init_db():
+    with transaction() as cursor:
+        # Таблица пользователей
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY,
+                telegram_id INTEGER UNIQUE,
+                username TEXT,
+                role TEXT DEFAULT 'buyer',
+                account_type TEXT DEFAULT 'free',
+                registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Таблица user_preferences (опционально, если нужно)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_preferences (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                city_preferences TEXT,
+                metal_preferences TEXT,
+                FOREIGN KEY(user_id) REFERENCES users(id)
+            )
+        ''')
+
+        # Таблица заявок
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS requests (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                req_type TEXT,
+                material TEXT,
+                quantity TEXT,
+                city TEXT,
+                info TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(user_id) REFERENCES users(id)
+            )
+        ''')
+
+        # Таблица фильтров уведомлений (города/материалы).
+        # Хранятся только отклонения от умолчания «все материалы и все города»:
+        # строка с is_enabled=0 означает, что пользователь отключил это значение.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS notification_filters (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                filter_type TEXT,  -- "material" или "city"
+                value TEXT,        -- название из каталога materials_and_cities
+                is_enabled INTEGER DEFAULT 0,
+                FOREIGN KEY(user_id) REFERENCES users(id)
+            )
+        ''')
+
+def add_user(telegram_id, username, role='buyer', account_type='free'):
+    with transaction() as cursor:
+        cursor.execute('''
+            INSERT OR IGNORE INTO users (telegram_id, username, role, account_type)
+            VALUES (?, ?, ?, ?)
+        ''', (telegram_id, username, role, account_type))
+        created = cursor.rowcount == 1
+        user_id = cursor.lastrowid
+    # Новый пользователь сразу подписан на всё — фильтры не создаём.
+    if created:
+        subscription_index.add_user(user_id)
 
 def get_user_by_telegram_id(telegram_id):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, telegram_id, username, role, account_type
-        FROM users
-        WHERE telegram_id = ?
-    ''', (telegram_id,))
-    row = cursor.fetchone()
-    conn.close()
-    return row
+    with transaction() as cursor:
+        cursor.execute('''
+            SELECT id, telegram_id, username, role, account_type
+            FROM users
+            WHERE telegram_id = ?
+        ''', (telegram_id,))
+        return cursor.fetchone()
 
 def delete_user_by_telegram_id(telegram_id):
     """
     Удаляет пользователя (и все его настройки) из БД.
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
-    user_row = cursor.fetchone()
-    if user_row:
+    with transaction() as cursor:
+        cursor.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
+        user_row = cursor.fetchone()
+        if not user_row:
+            return
         user_id = user_row[0]
         # Удаляем записи из notification_filters
         cursor.execute("DELETE FROM notification_filters WHERE user_id = ?", (user_id,))
@@ -108,131 +231,552 @@ def delete_user_by_telegram_id(telegram_id):
         cursor.execute("DELETE FROM requests WHERE user_id = ?", (user_id,))
         # Удаляем пользователя
         cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    subscription_index.remove_user(user_id)
 
 def add_request(user_id, req_type, material, quantity, city, info):
-    conn = get_connection()
-    cursor = conn.cursor()
+    with transaction() as cursor:
+        cursor.execute('''
+            INSERT INTO requests (user_id, req_type, material, quantity, city, info)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (user_id, req_type, material, quantity, city, info))
+
+def _write_notification_item(cursor, user_id, filter_type, value, enabled):
     cursor.execute('''
-        INSERT INTO requests (user_id, req_type, material, quantity, city, info)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (user_id, req_type, material, quantity, city, info))
-    conn.commit()
-    conn.close()
+        DELETE FROM notification_filters
+        WHERE user_id = ? AND filter_type = ? AND value = ?
+    ''', (user_id, filter_type, value))
+    if not enabled:
+        cursor.execute('''
+            INSERT INTO notification_filters (user_id, filter_type, value, is_enabled)
+            VALUES (?, ?, ?, 0)
+        ''', (user_id, filter_type, value))
 
-def init_notification_items_for_user(user_id):
+def set_notification_item(user_id, filter_type, value, enabled):
     """
-    Создаём 50 материалов ("Материал 1..50") и 50 городов ("Город 1..50"), все включены (is_enabled=1).
-    Если уже существуют записи, ничего не делаем.
+    Включает или отключает значение фильтра. Включённое значение совпадает
+    с умолчанием, поэтому строка удаляется; для отключённого хранится одна строка.
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM notification_filters WHERE user_id = ?", (user_id,))
-    count = cursor.fetchone()[0]
-    if count == 0:
-        for i in range(1, 51):
-            mat_val = f"Материал {i}"
-            city_val = f"Город {i}"
-            cursor.execute('''
-                INSERT INTO notification_filters (user_id, filter_type, value, is_enabled)
-                VALUES (?, 'material', ?, 1)
-            ''', (user_id, mat_val))
-            cursor.execute('''
-                INSERT INTO notification_filters (user_id, filter_type, value, is_enabled)
-                VALUES (?, 'city', ?, 1)
-            ''', (user_id, city_val))
-        conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        _write_notification_item(cursor, user_id, filter_type, value, enabled)
+    subscription_index.set_enabled(user_id, filter_type, value, enabled)
+
+def toggle_notification_item(user_id, filter_type, value):
+    """
+    Переключает значение фильтра и возвращает новое состояние (True — включено).
+    """
+    with transaction() as cursor:
+        cursor.execute('''
+            SELECT 1
+            FROM notification_filters
+            WHERE user_id = ? AND filter_type = ? AND value = ? AND is_enabled = 0
+            LIMIT 1
+        ''', (user_id, filter_type, value))
+        enabled = cursor.fetchone() is not None
+        _write_notification_item(cursor, user_id, filter_type, value, enabled)
+    subscription_index.set_enabled(user_id, filter_type, value, enabled)
+    return enabled
 
 def get_notification_items(user_id, filter_type):
     """
-    Возвращает список кортежей (id, value, is_enabled) для заданного user_id и filter_type.
+    Возвращает список кортежей (id, value, is_enabled) отклонений от умолчания
+    для заданного user_id и filter_type. Значения, которых нет в списке, включены.
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, value, is_enabled
-        FROM notification_filters
-        WHERE user_id = ? AND filter_type = ?
-        ORDER BY value
-    ''', (user_id, filter_type))
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    with transaction() as cursor:
+        cursor.execute('''
+            SELECT id, value, is_enabled
+            FROM notification_filters
+            WHERE user_id = ? AND filter_type = ?
+            ORDER BY value
+        ''', (user_id, filter_type))
+        return cursor.fetchall()
 
 def toggle_notification_item_by_id(user_id, filter_id):
     """
-    Переключаем is_enabled по конкретному ID из notification_filters
-    (принадлежащему тому же user_id).
+    Переключаем фильтр по конкретному ID из notification_filters
+    (принадлежащему тому же user_id). Нужен для кнопок, отправленных до перехода
+    на разреженное хранение.
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    # Ensure the filter belongs to this user
-    cursor.execute('''
-        SELECT is_enabled
-        FROM notification_filters
-        WHERE id = ? AND user_id = ?
-    ''', (filter_id, user_id))
-    row = cursor.fetchone()
-    if row:
-        current = row[0]
-        new_val = 0 if current == 1 else 1
+    with transaction() as cursor:
+        # Ensure the filter belongs to this user
         cursor.execute('''
-            UPDATE notification_filters
-            SET is_enabled = ?
+            SELECT is_enabled, filter_type, value
+            FROM notification_filters
             WHERE id = ? AND user_id = ?
-        ''', (new_val, filter_id, user_id))
-        conn.commit()
+        ''', (filter_id, user_id))
+        row = cursor.fetchone()
+        if not row:
+            return
+        current, filter_type, value = row
+        enabled = current == 0
+        _write_notification_item(cursor, user_id, filter_type, value, enabled)
+    subscription_index.set_enabled(user_id, filter_type, value, enabled)
 
-    conn.close()
+def add_radius_subscription(user_id, center, radius_km):
+    """
+    Подписка на заявки не дальше radius_km от города center (geo.py).
+    Строка фильтра хранится включённой: значения "центр|км" — не отклонения
+    от умолчания, а ограничение городов. Возвращает значение фильтра или
+    None, если координат центра нет в таблице.
+    """
+    title = geo_index.title(center)
+    if title is None:
+        return None
+    value = format_radius(title, min(int(radius_km), MAX_RADIUS_KM))
+    with transaction() as cursor:
+        cursor.execute('''
+            DELETE FROM notification_filters
+            WHERE user_id = ? AND filter_type = 'radius' AND value = ?
+        ''', (user_id, value))
+        cursor.execute('''
+            INSERT INTO notification_filters (user_id, filter_type, value, is_enabled)
+            VALUES (?, 'radius', ?, 1)
+        ''', (user_id, value))
+    subscription_index.set_enabled(user_id, "radius", value, True)
+    return value
+
+def remove_radius_subscription(user_id, filter_id):
+    """
+    Удаляет подписку по радиусу по id строки notification_filters.
+    Возвращает её значение или None, если строки нет.
+    """
+    with transaction() as cursor:
+        cursor.execute('''
+            DELETE FROM notification_filters
+            WHERE id = ? AND user_id = ? AND filter_type = 'radius'
+            RETURNING value
+        ''', (filter_id, user_id))
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    subscription_index.set_enabled(user_id, "radius", row[0], False)
+    return row[0]
 
 def get_telegram_id_by_user_id(user_id):
     """
     Возвращает telegram_id пользователя по его внутреннему ID (users.id).
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT telegram_id FROM users WHERE id = ?", (user_id,))
-    row = cursor.fetchone()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute("SELECT telegram_id FROM users WHERE id = ?", (user_id,))
+        row = cursor.fetchone()
     if row:
         return row[0]
     return None
 
+def _fetch_subscriptions():
+    with transaction() as cursor:
+        cursor.execute("SELECT id FROM users")
+        user_ids = [r[0] for r in cursor.fetchall()]
+        cursor.execute('''
+            SELECT user_id, filter_type, value
+            FROM notification_filters
+            WHERE is_enabled = 0 OR filter_type = 'radius'
+        ''')
+        return user_ids, cursor.fetchall()
+
 def get_users_for_notification(material, city):
     """
-    Возвращает список user_id, у которых включены фильтры по данному material И по данному city.
-    Используем INTERSECT для пересечения.
+    Возвращает список user_id, у которых не отключены ни данный material, ни данный city.
+    Ответ берётся из индекса подписок в памяти (subscription_index).
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT user_id
-        FROM notification_filters
-        WHERE filter_type='material' AND value=? AND is_enabled=1
-        INTERSECT
-        SELECT user_id
-        FROM notification_filters
-        WHERE filter_type='city' AND value=? AND is_enabled=1
-    ''', (material, city))
-    rows = cursor.fetchall()
-    conn.close()
-    return [r[0] for r in rows]
-
-def get_all_requests():
-    """
-    Возвращает список всех заявок (id, req_type, material, quantity, city, info, created_at).
-    Можно дописать лимит, сортировку и т.д.
+    if not subscription_index.loaded:
+        subscription_index.load(_fetch_subscriptions)
+    return subscription_index.match(material, city)
+
+def get_recipients(user_ids):
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, req_type, material, quantity, city, info, created_at
-        FROM requests
-        ORDER BY created_at DESC
-    ''')
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    Возвращает [(user_id, telegram_id, account_type), ...] для заданных users.id одним запросом.
+    """
+    if not user_ids:
+        return []
+    placeholders = ",".join("?" * len(user_ids))
+    with transaction() as cursor:
+        cursor.execute(f'''
+            SELECT id, telegram_id, account_type
+            FROM users
+            WHERE id IN ({placeholders}) AND telegram_id IS NOT NULL
+            ORDER BY id
+        ''', list(user_ids))
+        return cursor.fetchall()
+
+RECIPIENTS_BATCH_SIZE = 500
+
+def delivery_tier(account_type):
+    """
+    (priority, delay) доставки для типа аккаунта: Pro — (0, 0),
+    остальные — (1, задержка из DELIVERY_DELAYS).
+    """
+    if account_type == "pro":
+        return 0, DELIVERY_DELAYS["pro"]
+    return 1, DELIVERY_DELAYS.get(account_type, DELIVERY_DELAYS["free"])
+
+def _open_digests(cursor, digests, digest_ids):
+    """
+    Открывает дайджесты для новых пользователей digests ({user_id: строка outbox})
+    и дописывает в digest_ids номера их открытых дайджестов (user_id → outbox.id).
+    """
+    cursor.executemany('''
+        INSERT INTO outbox (user_id, chat_id, text, parse_mode, due_at, priority, digest)
+        VALUES (?, ?, '', ?, ?, ?, 1)
+        ON CONFLICT (user_id) WHERE status = 'pending' AND digest = 1 AND attempts = 0 DO NOTHING
+    ''', digests.values())
+    user_ids = list(digests)
+    for start in range(0, len(user_ids), RECIPIENTS_BATCH_SIZE):
+        batch = user_ids[start:start + RECIPIENTS_BATCH_SIZE]
+        placeholders = ",".join("?" * len(batch))
+        # без подсказки при длинном IN планировщик выбирает idx_outbox_claim
+        # и перебирает всю очередь
+        cursor.execute(f'''
+            SELECT user_id, id FROM outbox INDEXED BY idx_outbox_open_digest
+            WHERE user_id IN ({placeholders}) AND status = 'pending' AND digest = 1 AND attempts = 0
+        ''', batch)
+        digest_ids.update(cursor.fetchall())
+
+def _enqueue(cursor, recipients, text, parse_mode, summary, now, digest_ids):
+    """
+    Строки outbox для получателей [(user_id, telegram_id, account_type), ...]:
+    отдельные сообщения или строки дайджестов (см. enqueue_notifications).
+    digest_ids — кэш открытых дайджестов на время транзакции.
+    """
+    messages, items, digests = [], [], {}
+    for user_id, telegram_id, account_type in recipients:
+        priority, delay = delivery_tier(account_type)
+        window = DIGEST_WINDOWS.get(account_type, 0)
+        if window:
+            if user_id not in digest_ids:
+                digests[user_id] = (user_id, telegram_id, parse_mode, now + max(delay, window), priority)
+            items.append(user_id)
+        else:
+            messages.append((user_id, telegram_id, text, parse_mode, now + delay, priority))
+    if digests:
+        _open_digests(cursor, digests, digest_ids)
+    cursor.executemany('''
+        INSERT INTO outbox (user_id, chat_id, text, parse_mode, due_at, priority)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', messages)
+    cursor.executemany("INSERT INTO outbox_items (outbox_id, text) VALUES (?, ?)",
+                       [(digest_ids[user_id], summary) for user_id in items])
+    return len(messages) + len(items)
+
+def enqueue_notifications(material, city, text, parse_mode=None, exclude_user_id=None, summary=None, now=None):
+    """
+    Ставит в очередь outbox уведомление о заявке всем подписчикам material и city
+    (кроме exclude_user_id). Получатели берутся из индекса подписок, профили —
+    пачками; срок и приоритет доставки зависят от account_type (delivery_tier).
+    Для типов с окном DIGEST_WINDOWS вместо отдельного сообщения строка summary
+    (по умолчанию text) добавляется в открытый дайджест пользователя, а если
+    его нет — открывается новый со сроком через окно.
+    Возвращает число получателей.
+    """
+    user_ids = [uid for uid in get_users_for_notification(material, city) if uid != exclude_user_id]
+    now = time.time() if now is None else now
+    summary = text if summary is None else summary
+    digest_ids = {}
+    queued = 0
+    with transaction() as cursor:
+        for start in range(0, len(user_ids), RECIPIENTS_BATCH_SIZE):
+            recipients = get_recipients(user_ids[start:start + RECIPIENTS_BATCH_SIZE])
+            queued += _enqueue(cursor, recipients, text, parse_mode, summary, now, digest_ids)
+    return queued
+
+def enqueue_notifications_bulk(notifications, parse_mode=None, now=None):
+    """
+    Пакетный вариант enqueue_notifications для списка заявок
+    [(material, city, text, summary), ...] в одной транзакции. Получатели
+    подбираются один раз на каждую различную пару (material, city).
+    Возвращает число получателей по всем заявкам.
+    """
+    now = time.time() if now is None else now
+    recipients_by_pair = {}
+    digest_ids = {}
+    queued = 0
+    with transaction() as cursor:
+        for material, city, text, summary in notifications:
+            recipients = recipients_by_pair.get((material, city))
+            if recipients is None:
+                user_ids = get_users_for_notification(material, city)
+                recipients = [row for start in range(0, len(user_ids), RECIPIENTS_BATCH_SIZE)
+                              for row in get_recipients(user_ids[start:start + RECIPIENTS_BATCH_SIZE])]
+                recipients_by_pair[(material, city)] = recipients
+            queued += _enqueue(cursor, recipients, text, parse_mode,
+                               text if summary is None else summary, now, digest_ids)
+    return queued
+
+def claim_outbox(limit=50, now=None):
+    """
+    Забирает до limit готовых к отправке сообщений (status='pending', due_at наступил),
+    сначала Pro (priority 0): переводит их в 'sending' и возвращает
+    [(id, chat_id, text, parse_mode, attempts, items), ...] в порядке приоритета;
+    items — строки дайджеста или None для обычного сообщения.
+    """
+    now = time.time() if now is None else now
+    with transaction() as cursor:
+        cursor.execute('''
+            UPDATE outbox
+            SET status = 'sending', attempts = attempts + 1
+            WHERE id IN (
+                SELECT id FROM outbox
+                WHERE status = 'pending' AND due_at <= ?
+                ORDER BY priority, due_at, id
+                LIMIT ?
+            )
+            RETURNING id, chat_id, text, parse_mode, attempts, priority, due_at, digest
+        ''', (now, limit))
+        rows = sorted(cursor.fetchall(), key=lambda r: (r[5], r[6], r[0]))
+        items = {row[0]: [] for row in rows if row[7]}
+        if items:
+            placeholders = ",".join("?" * len(items))
+            cursor.execute(f'''
+                SELECT outbox_id, text FROM outbox_items
+                WHERE outbox_id IN ({placeholders})
+                ORDER BY id
+            ''', list(items))
+            for outbox_id, text in cursor.fetchall():
+                items[outbox_id].append(text)
+    return [row[:5] + (items.get(row[0]),) for row in rows]
+
+def finish_outbox(sent_ids=(), retries=(), failed=()):
+    """
+    Записывает итог отправки: sent_ids — доставлены; retries — [(id, due_at, error)]
+    вернуть в очередь на потом; failed — [(id, error)] больше не пытаться.
+    """
+    with transaction() as cursor:
+        cursor.executemany(
+            "UPDATE outbox SET status = 'sent', sent_at = CURRENT_TIMESTAMP, last_error = NULL WHERE id = ?",
+            [(i,) for i in sent_ids])
+        cursor.executemany(
+            "UPDATE outbox SET status = 'pending', due_at = ?, last_error = ? WHERE id = ?",
+            [(due_at, error, i) for i, due_at, error in retries])
+        cursor.executemany(
+            "UPDATE outbox SET status = 'failed', last_error = ? WHERE id = ?",
+            [(error, i) for i, error in failed])
+
+def requeue_claimed_outbox():
+    """
+    Возвращает в очередь сообщения, взятые в работу, но не отправленные
+    до остановки процесса. Вызывается при старте единственного отправителя.
+    """
+    with transaction() as cursor:
+        cursor.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'")
+        return cursor.rowcount
+
+def purge_outbox(older_than_days=7):
+    """
+    Удаляет доставленные и окончательно неотправленные сообщения старше older_than_days.
+    """
+    with transaction() as cursor:
+        cursor.execute('''
+            DELETE FROM outbox
+            WHERE status IN ('sent', 'failed') AND created_at < datetime('now', ?)
+        ''', (f"-{int(older_than_days)} days",))
+        purged = cursor.rowcount
+        cursor.execute("DELETE FROM outbox_items WHERE outbox_id NOT IN (SELECT id FROM outbox)")
+        return purged
+
+def get_outbox_stats():
+    """
+    Число сообщений очереди по статусам: {"pending": n, "sent": n, ...}.
+    """
+    with transaction() as cursor:
+        cursor.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status")
+        return dict(cursor.fetchall())
+
+def remember_order_keys(keys, ttl=ORDER_DEDUP_TTL, max_keys=ORDER_DEDUP_MAX_KEYS, now=None):
+    """
+    Отмечает ключи заказов (orders.idempotency_key) как принятые и возвращает
+    те, которых ещё не было, в порядке keys (повтор внутри keys — тоже дубль).
+    Ключи старше ttl секунд вытесняются, хранится не больше max_keys последних.
+    """
+    now = time.time() if now is None else now
+    fresh = []
+    with transaction() as cursor:
+        cursor.execute("DELETE FROM seen_orders WHERE seen_at < ?", (now - ttl,))
+        for key in keys:
+            cursor.execute("INSERT OR IGNORE INTO seen_orders (key, seen_at) VALUES (?, ?)", (key, now))
+            if cursor.rowcount:
+                fresh.append(key)
+        if fresh:
+            cursor.execute("DELETE FROM seen_orders WHERE id <= (SELECT MAX(id) FROM seen_orders) - ?",
+                           (max_keys,))
+    return fresh
+
+def ingest_orders(entries, parse_mode=None, now=None):
+    """
+    Принимает заказы из вебхука: entries — [(ключ, orders.Order или None,
+    (material, city, text, summary)), ...]. Отметка ключей (remember_order_keys),
+    сохранение новых заказов и постановка их уведомлений в outbox идут одной
+    транзакцией: ключ не может оказаться принятым без поставленных сообщений,
+    даже если процесс упадёт посередине. Повторы пропускаются.
+    Возвращает (число новых заказов, число получателей).
+    """
+    with transaction():
+        fresh = set(remember_order_keys([key for key, _order, _notification in entries], now=now))
+        new = []
+        for key, order, notification in entries:
+            if key in fresh:
+                fresh.discard(key)
+                new.append((order, notification))
+        if not new:
+            return 0, 0
+        orders = [order for order, _notification in new if order is not None]
+        if orders:
+            upsert_orders(orders)
+        queued = enqueue_notifications_bulk([notification for _order, notification in new], parse_mode, now)
+    return len(new), queued
+
+def parse_cursor(cursor):
+    """
+    Разбирает курсор страницы: "" — первая страница, ">id" — страница после
+    записи id, "<id" — страница перед ней. Возвращает (direction, id).
+    """
+    if cursor and cursor[0] in "<>" and cursor[1:].isdigit():
+        return cursor[0], int(cursor[1:])
+    return "", None
+
+def keyset_cursors(rows, direction, has_more):
+    """
+    По строкам страницы (id — первое поле, в порядке показа) возвращает
+    курсоры (prev_cursor, next_cursor); None — в эту сторону страниц нет.
+    has_more — нашлась ли строка сверх лимита в направлении выборки.
+    """
+    if not rows:
+        return None, None
+    if direction == "<":
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = direction == ">", has_more
+    prev_cursor = f"<{rows[0][0]}" if has_prev else None
+    next_cursor = f">{rows[-1][0]}" if has_next else None
+    return prev_cursor, next_cursor
+
+def upsert_orders(orders):
+    """
+    Сохраняет заказы Scraptraffic (orders.Order) в локальную таблицу orders.
+    Неизменившиеся строки не переписываются, так что индекс orders_fts
+    обновляется только для новых и изменённых заказов. Возвращает число
+    вставленных или обновлённых строк.
+    """
+    with transaction() as cursor:
+        cursor.executemany('''
+            INSERT INTO orders (order_id, material, quantity, city, comment, date, search_key)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(order_id) DO UPDATE SET
+                material = excluded.material,
+                quantity = excluded.quantity,
+                city = excluded.city,
+                comment = excluded.comment,
+                date = excluded.date,
+                search_key = excluded.search_key
+            WHERE (material, quantity, city, comment, date)
+                IS NOT (excluded.material, excluded.quantity, excluded.city, excluded.comment, excluded.date)
+        ''', [order.as_row() for order in orders])
+        return cursor.rowcount
+
+def get_orders_watermark():
+    """
+    Отметка синхронизации локальной копии заказов: (max_date, max_order_id)
+    или ("", 0), пока таблица пуста.
+    """
+    with transaction() as cursor:
+        cursor.execute("SELECT COALESCE(MAX(date), ''), COALESCE(MAX(order_id), 0) FROM orders")
+        return cursor.fetchone()
+
+def get_orders_page(page_cursor="", limit=10):
+    """
+    Одна страница локальной копии заказов (orders.Order), новые сверху,
+    по ключу (date, order_id) и индексу idx_orders_date.
+    Курсоры — как в parse_cursor. Возвращает (rows, prev_cursor, next_cursor).
+    """
+    direction, cursor_id = parse_cursor(page_cursor)
+    with transaction() as cursor:
+        if direction == ">":
+            cursor.execute('''
+                SELECT order_id, material, quantity, city, comment, date, search_key
+                FROM orders
+                WHERE (date, order_id) < (SELECT date, order_id FROM orders WHERE order_id = ?)
+                ORDER BY date DESC, order_id DESC
+                LIMIT ?
+            ''', (cursor_id, limit + 1))
+        elif direction == "<":
+            cursor.execute('''
+                SELECT order_id, material, quantity, city, comment, date, search_key
+                FROM orders
+                WHERE (date, order_id) > (SELECT date, order_id FROM orders WHERE order_id = ?)
+                ORDER BY date ASC, order_id ASC
+                LIMIT ?
+            ''', (cursor_id, limit + 1))
+        else:
+            cursor.execute('''
+                SELECT order_id, material, quantity, city, comment, date, search_key
+                FROM orders
+                ORDER BY date DESC, order_id DESC
+                LIMIT ?
+            ''', (limit + 1,))
+        rows = cursor.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "<":
+        rows.reverse()
+    if not rows and direction:
+        return get_orders_page("", limit)
+    prev_cursor, next_cursor = keyset_cursors(rows, direction, has_more)
+    return [Order(*row) for row in rows], prev_cursor, next_cursor
+
+def _search_queries(query):
+    """
+    SQL первой страницы, страницы после и перед курсором и параметры поиска.
+    Запросы от трёх символов идут через FTS5 и ранжируются по bm25 (rank,
+    меньше — релевантнее), ключ страницы — (rank, -order_id). Более короткие
+    триграммы не покрывают: их ищем перебором от новых заказов к старым,
+    и выборка останавливается, набрав страницу.
+    """
+    columns = "o.order_id, o.material, o.quantity, o.city, o.comment, o.date, o.search_key"
+    query = query.strip()
+    if len(query) >= 3:
+        phrase = '"' + query.replace('"', '""') + '"'
+        select = f'''
+            WITH hits AS MATERIALIZED (
+                SELECT rowid AS order_id, rank FROM orders_fts WHERE orders_fts MATCH ?
+            )
+            SELECT {columns}
+            FROM hits h JOIN orders o ON o.order_id = h.order_id
+        '''
+        anchor = "(SELECT rank, -order_id FROM hits WHERE order_id = ?)"
+        return (
+            select + "ORDER BY h.rank, h.order_id DESC LIMIT ?",
+            select + f"WHERE (h.rank, -h.order_id) > {anchor} ORDER BY h.rank, h.order_id DESC LIMIT ?",
+            select + f"WHERE (h.rank, -h.order_id) < {anchor} ORDER BY h.rank DESC, h.order_id LIMIT ?",
+            [phrase],
+        )
+    select = f"SELECT {columns} FROM orders o WHERE instr(o.search_key, ?) > 0"
+    return (
+        select + " ORDER BY o.order_id DESC LIMIT ?",
+        select + " AND o.order_id < ? ORDER BY o.order_id DESC LIMIT ?",
+        select + " AND o.order_id > ? ORDER BY o.order_id LIMIT ?",
+        [query.casefold()],
+    )
+
+def search_orders(query, page_cursor="", limit=10):
+    """
+    Страница результатов поиска по заказам (orders.Order):
+    сначала самые релевантные, при равной релевантности — новые.
+    Курсоры — как в parse_cursor.
+    Возвращает (rows, prev_cursor, next_cursor).
+    """
+    direction, cursor_id = parse_cursor(page_cursor)
+    first_sql, after_sql, before_sql, params = _search_queries(query)
+    with transaction() as cursor:
+        if direction == ">":
+            cursor.execute(after_sql, params + [cursor_id, limit + 1])
+        elif direction == "<":
+            cursor.execute(before_sql, params + [cursor_id, limit + 1])
+        else:
+            cursor.execute(first_sql, params + [limit + 1])
+        rows = cursor.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "<":
+        rows.reverse()
+    if not rows and direction:
+        return search_orders(query, "", limit)
+    prev_cursor, next_cursor = keyset_cursors(rows, direction, has_more)
+    return [Order(*row) for row in rows], prev_cursor, next_cursor
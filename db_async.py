@@ -0,0 +1,103 @@
+"""
+db_async.py
+Асинхронные аналоги функций db.py для кода на asyncio (handlers.py, index.py).
+Все запросы выполняются в отдельном потоке БД, поэтому медленный fsync
+не останавливает event loop и не задерживает остальных пользователей.
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import migrations
+
+# Один поток: SQLite всё равно сериализует запись, а одно долгоживущее
+# соединение этого потока переиспользуется всеми запросами.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+
+async def run_in_db(func, *args, **kwargs):
+    """
+    Выполняет синхронную функцию в потоке БД и возвращает её результат.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def shutdown():
+    """
+    Закрывает соединения и останавливает поток БД (вызывается при остановке процесса).
+    """
+    _executor.submit(db.close_connections).result()
+    _executor.shutdown(wait=True)
+
+
+async def init_db():
+    return await run_in_db(db.init_db)
+
+async def run_migrations():
+    return await run_in_db(migrations.run_migrations)
+
+async def add_user(telegram_id, username, role='buyer', account_type='free'):
+    return await run_in_db(db.add_user, telegram_id, username, role, account_type)
+
+async def get_user_by_telegram_id(telegram_id):
+    return await run_in_db(db.get_user_by_telegram_id, telegram_id)
+
+async def delete_user_by_telegram_id(telegram_id):
+    return await run_in_db(db.delete_user_by_telegram_id, telegram_id)
+
+async def add_request(user_id, req_type, material, quantity, city, info):
+    return await run_in_db(db.add_request, user_id, req_type, material, quantity, city, info)
+
+async def set_notification_item(user_id, filter_type, value, enabled):
+    return await run_in_db(db.set_notification_item, user_id, filter_type, value, enabled)
+
+async def toggle_notification_item(user_id, filter_type, value):
+    return await run_in_db(db.toggle_notification_item, user_id, filter_type, value)
+
+async def add_radius_subscription(user_id, center, radius_km):
+    return await run_in_db(db.add_radius_subscription, user_id, center, radius_km)
+
+async def remove_radius_subscription(user_id, filter_id):
+    return await run_in_db(db.remove_radius_subscription, user_id, filter_id)
+
+async def get_notification_items(user_id, filter_type):
+    return await run_in_db(db.get_notification_items, user_id, filter_type)
+
+async def toggle_notification_item_by_id(user_id, filter_id):
+    return await run_in_db(db.toggle_notification_item_by_id, user_id, filter_id)
+
+async def enqueue_notifications(material, city, text, parse_mode=None, exclude_user_id=None, summary=None):
+    return await run_in_db(db.enqueue_notifications, material, city, text, parse_mode, exclude_user_id, summary)
+
+async def claim_outbox(limit=50):
+    return await run_in_db(db.claim_outbox, limit)
+
+async def finish_outbox(sent_ids=(), retries=(), failed=()):
+    return await run_in_db(db.finish_outbox, sent_ids, retries, failed)
+
+async def requeue_claimed_outbox():
+    return await run_in_db(db.requeue_claimed_outbox)
+
+async def purge_outbox(older_than_days=7):
+    return await run_in_db(db.purge_outbox, older_than_days)
+
+async def get_outbox_stats():
+    return await run_in_db(db.get_outbox_stats)
+
+async def ingest_orders(entries, parse_mode=None):
+    return await run_in_db(db.ingest_orders, entries, parse_mode)
+
+async def upsert_orders(orders):
+    return await run_in_db(db.upsert_orders, orders)
+
+async def get_orders_watermark():
+    return await run_in_db(db.get_orders_watermark)
+
+async def get_orders_page(page_cursor="", limit=10):
+    return await run_in_db(db.get_orders_page, page_cursor, limit)
+
+async def search_orders(query, page_cursor="", limit=10):
+    return await run_in_db(db.search_orders, query, page_cursor, limit)
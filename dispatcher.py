@@ -0,0 +1,134 @@
+"""
+dispatcher.py
+Рассылка уведомлений в Telegram с учётом его лимитов: общий token bucket
+(~30 сообщений в секунду на бота), не чаще одного сообщения в секунду
+в один чат, ограниченное число одновременных отправок, повтор после
+RetryAfter и сетевых ошибок. Через него отправляет очередь outbox
+(outbox.py), куда пишут оба пути рассылки.
+"""
+
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Исход send(): доставлено, стоит повторить позже, повтор не поможет
+SENT = "sent"
+RETRY = "retry"
+FAILED = "failed"
+
+
+class TokenBucket:
+    """
+    rate токенов в секунду, не больше capacity накопленных.
+    pause() останавливает выдачу целиком (ответ RetryAfter от Telegram).
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        # после паузы начинаем с пустого ведра, без накопленного всплеска
+        self._updated = self._paused_until
+        self._tokens = 0
+
+
+class Dispatcher:
+    """
+    send() отправляет одно сообщение с учётом общего лимита, очереди чата
+    и ограничения одновременных отправок.
+    Ошибки отправки логируются и считаются в метриках, но не пробрасываются.
+    """
+
+    def __init__(self, rate=30, chat_interval=1.0, concurrency=20, max_retries=3, backoff=0.5):
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._slots = asyncio.Semaphore(concurrency)
+        self._chat_next = {}
+        self.stats = {"sent": 0, "failed": 0, "retries": 0, "retry_after": 0,
+                      "send_ms_total": 0.0, "send_ms_max": 0.0}
+
+    async def _pace_chat(self, chat_id):
+        now = time.monotonic()
+        if len(self._chat_next) > 10000:
+            self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+        ready_at = self._chat_next.get(chat_id, 0.0)
+        self._chat_next[chat_id] = max(now, ready_at) + self.chat_interval
+        if ready_at > now:
+            await asyncio.sleep(ready_at - now)
+
+    async def send(self, bot, chat_id, text, **kwargs):
+        """
+        Отправляет сообщение с учётом лимитов. Возвращает (исход, текст ошибки):
+        SENT; FAILED — бот заблокирован или запрос неверен;
+        RETRY — попытки исчерпаны на временных ошибках.
+        """
+        # ожидание очереди чата — до занятия слота, чтобы частые сообщения
+        # одному чату не держали слоты, нужные остальным
+        await self._pace_chat(chat_id)
+        async with self._slots:
+            error = None
+            for attempt in range(self.max_retries + 1):
+                await self.bucket.acquire()
+                started = time.perf_counter()
+                try:
+                    await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                except RetryAfter as e:
+                    error = str(e)
+                    self.stats["retry_after"] += 1
+                    self.bucket.pause(e.retry_after)
+                    logger.warning("RetryAfter %s s while sending to %s", e.retry_after, chat_id)
+                except (Forbidden, BadRequest) as e:
+                    # бот заблокирован или чат недоступен — повтор не поможет
+                    logger.error("Failed to send to %s: %s", chat_id, e)
+                    self.stats["failed"] += 1
+                    return FAILED, str(e)
+                except NetworkError as e:
+                    error = str(e)
+                    logger.warning("Network error sending to %s (attempt %s): %s", chat_id, attempt + 1, e)
+                    if attempt < self.max_retries:
+                        await asyncio.sleep(self.backoff * 2 ** attempt)
+                else:
+                    elapsed_ms = (time.perf_counter() - started) * 1000
+                    self.stats["sent"] += 1
+                    self.stats["send_ms_total"] += elapsed_ms
+                    self.stats["send_ms_max"] = max(self.stats["send_ms_max"], elapsed_ms)
+                    return SENT, None
+                if attempt < self.max_retries:
+                    self.stats["retries"] += 1
+            self.stats["failed"] += 1
+            return RETRY, error
+
+    def metrics(self):
+        stats = dict(self.stats)
+        stats["send_ms_avg"] = round(stats["send_ms_total"] / stats["sent"], 2) if stats["sent"] else 0.0
+        return stats
+
+
+dispatcher = Dispatcher()
@@ -0,0 +1,249 @@
+"""
+geo.py
+Подписки на заявки в радиусе от города ("в 300 км от Екатеринбурга").
+Координаты городов — офлайн-таблица CITY_COORDINATES. Для каждого города
+один раз при загрузке строится список соседей в пределах MAX_RADIUS_KM,
+отсортированный по расстоянию, так что круг (центр, радиус) разворачивается
+в список городов бинарным поиском, без перебора всей таблицы. Индекс подписок
+(matcher.py) разворачивает круг при записи подписки, а при подборе получателей
+город заказа — один поиск в словаре, без расчёта расстояний.
+"""
+
+import bisect
+import math
+import re
+
+from normalize import CITY_PREFIXES, fold
+
+# Наибольший радиус подписки, км
+MAX_RADIUS_KM = 1000
+
+# Разделитель центра и радиуса в значении фильтра: "Екатеринбург|300"
+RADIUS_SEPARATOR = "|"
+
+EARTH_RADIUS_KM = 6371.0
+
+# Город → (широта, долгота)
+CITY_COORDINATES = {
+    "Москва": (55.756, 37.617),
+    "Санкт-Петербург": (59.939, 30.316),
+    "Новосибирск": (55.030, 82.920),
+    "Екатеринбург": (56.838, 60.605),
+    "Казань": (55.796, 49.106),
+    "Нижний Новгород": (56.327, 44.006),
+    "Челябинск": (55.160, 61.403),
+    "Самара": (53.195, 50.101),
+    "Омск": (54.989, 73.368),
+    "Ростов-на-Дону": (47.222, 39.720),
+    "Уфа": (54.735, 55.958),
+    "Красноярск": (56.010, 92.852),
+    "Воронеж": (51.661, 39.200),
+    "Пермь": (58.010, 56.229),
+    "Волгоград": (48.708, 44.513),
+    "Краснодар": (45.035, 38.975),
+    "Саратов": (51.533, 46.034),
+    "Тюмень": (57.153, 65.534),
+    "Тольятти": (53.508, 49.419),
+    "Ижевск": (56.852, 53.204),
+    "Барнаул": (53.348, 83.780),
+    "Ульяновск": (54.314, 48.403),
+    "Иркутск": (52.287, 104.305),
+    "Хабаровск": (48.480, 135.072),
+    "Ярославль": (57.626, 39.894),
+    "Владивосток": (43.115, 131.885),
+    "Махачкала": (42.983, 47.504),
+    "Томск": (56.484, 84.948),
+    "Оренбург": (51.768, 55.097),
+    "Кемерово": (55.355, 86.087),
+    "Новокузнецк": (53.757, 87.136),
+    "Рязань": (54.629, 39.742),
+    "Астрахань": (46.348, 48.033),
+    "Набережные Челны": (55.743, 52.396),
+    "Пенза": (53.195, 45.018),
+    "Киров": (58.603, 49.668),
+    "Липецк": (52.608, 39.599),
+    "Чебоксары": (56.146, 47.250),
+    "Калининград": (54.710, 20.511),
+    "Тула": (54.193, 37.617),
+    "Курск": (51.730, 36.193),
+    "Ставрополь": (45.044, 41.969),
+    "Сочи": (43.585, 39.723),
+    "Улан-Удэ": (51.834, 107.584),
+    "Тверь": (56.859, 35.912),
+    "Магнитогорск": (53.407, 58.980),
+    "Иваново": (57.000, 40.973),
+    "Брянск": (53.243, 34.364),
+    "Белгород": (50.595, 36.587),
+    "Сургут": (61.254, 73.396),
+    "Владимир": (56.129, 40.407),
+    "Чита": (52.034, 113.499),
+    "Архангельск": (64.539, 40.516),
+    "Нижний Тагил": (57.910, 59.981),
+    "Симферополь": (44.952, 34.102),
+    "Севастополь": (44.617, 33.525),
+    "Калуга": (54.514, 36.262),
+    "Смоленск": (54.783, 32.045),
+    "Волжский": (48.786, 44.752),
+    "Якутск": (62.028, 129.732),
+    "Саранск": (54.187, 45.184),
+    "Череповец": (59.122, 37.903),
+    "Курган": (55.441, 65.341),
+    "Вологда": (59.220, 39.891),
+    "Орёл": (52.967, 36.070),
+    "Владикавказ": (43.020, 44.682),
+    "Грозный": (43.318, 45.695),
+    "Мурманск": (68.970, 33.075),
+    "Тамбов": (52.721, 41.452),
+    "Петрозаводск": (61.790, 34.390),
+    "Кострома": (57.768, 40.927),
+    "Нижневартовск": (60.939, 76.570),
+    "Новороссийск": (44.724, 37.769),
+    "Йошкар-Ола": (56.634, 47.899),
+    "Сыктывкар": (61.669, 50.836),
+    "Великий Новгород": (58.522, 31.270),
+    "Псков": (57.819, 28.332),
+    "Стерлитамак": (53.630, 55.930),
+    "Старый Оскол": (51.296, 37.842),
+    "Таганрог": (47.236, 38.897),
+    "Шахты": (47.709, 40.216),
+    "Армавир": (44.999, 41.129),
+    "Пятигорск": (44.049, 43.060),
+    "Нальчик": (43.485, 43.607),
+    "Майкоп": (44.609, 40.106),
+    "Черкесск": (44.227, 42.058),
+    "Элиста": (46.308, 44.256),
+    "Березники": (59.408, 56.805),
+    "Златоуст": (55.172, 59.672),
+    "Миасс": (55.045, 60.108),
+    "Копейск": (55.117, 61.626),
+    "Каменск-Уральский": (56.414, 61.918),
+    "Первоуральск": (56.908, 59.943),
+    "Верхняя Пышма": (56.976, 60.565),
+    "Березовский": (56.910, 60.809),
+    "Ревда": (56.798, 59.907),
+    "Асбест": (57.005, 61.458),
+    "Полевской": (56.443, 60.188),
+    "Серов": (59.604, 60.575),
+    "Тобольск": (58.198, 68.254),
+    "Ханты-Мансийск": (61.003, 69.019),
+    "Салехард": (66.530, 66.603),
+    "Норильск": (69.349, 88.201),
+    "Абакан": (53.722, 91.442),
+    "Кызыл": (51.719, 94.437),
+    "Горно-Алтайск": (51.958, 85.960),
+    "Благовещенск": (50.290, 127.527),
+    "Биробиджан": (48.795, 132.923),
+    "Южно-Сахалинск": (46.959, 142.738),
+    "Магадан": (59.568, 150.808),
+    "Петропавловск-Камчатский": (53.024, 158.643),
+    "Анадырь": (64.734, 177.514),
+}
+
+
+def haversine_km(a, b):
+    """
+    Расстояние по поверхности Земли между точками (широта, долгота), км.
+    """
+    lat1, lon1 = map(math.radians, a)
+    lat2, lon2 = map(math.radians, b)
+    h = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(h))
+
+
+def city_key(city):
+    """
+    Ключ города для поиска в таблице: свёрнутая форма без "г." и "город".
+    """
+    return CITY_PREFIXES.sub("", fold(city))
+
+
+def format_radius(center, radius_km):
+    return f"{center}{RADIUS_SEPARATOR}{int(radius_km)}"
+
+
+def parse_radius(value):
+    """
+    Значение фильтра "Екатеринбург|300" → ("Екатеринбург", 300) или None.
+    """
+    center, sep, radius = str(value).rpartition(RADIUS_SEPARATOR)
+    if not sep or not radius.isdigit():
+        return None
+    return center, int(radius)
+
+
+_RADIUS_INPUT = re.compile(r"^(.+?)[\s,;]+(\d+)\s*(?:км|km)?\.?$", re.IGNORECASE)
+
+
+def parse_radius_input(text):
+    """
+    Ввод пользователя "Екатеринбург 300" или "Екатеринбург, 300 км" → (город, км) или None.
+    """
+    match = _RADIUS_INPUT.match(text.strip())
+    if not match:
+        return None
+    return match.group(1).strip(), int(match.group(2))
+
+
+class GeoIndex:
+    """
+    Таблица координат и для каждого города — соседи в пределах max_radius
+    [(расстояние, ключ), ...] по возрастанию расстояния (включая сам город).
+    Пары ищутся проходом по городам, отсортированным по широте: дальше
+    max_radius по широте сравнивать уже не нужно.
+    """
+
+    def __init__(self, coordinates, max_radius=MAX_RADIUS_KM):
+        self.max_radius = max_radius
+        self.titles = {city_key(title): title for title in coordinates}
+        points = sorted((lat, lon, city_key(title)) for title, (lat, lon) in coordinates.items())
+        lat_window = max_radius / (math.pi * EARTH_RADIUS_KM / 180)
+        neighbours = {key: [(0.0, key)] for _lat, _lon, key in points}
+        for i, (lat, lon, key) in enumerate(points):
+            for other_lat, other_lon, other in points[i + 1:]:
+                if other_lat - lat > lat_window:
+                    break
+                distance = haversine_km((lat, lon), (other_lat, other_lon))
+                if distance <= max_radius:
+                    neighbours[key].append((distance, other))
+                    neighbours[other].append((distance, key))
+        self._neighbours = {}
+        self._distances = {}
+        for key, items in neighbours.items():
+            items.sort()
+            self._distances[key] = [distance for distance, _other in items]
+            self._neighbours[key] = [other for _distance, other in items]
+
+    def title(self, city):
+        """
+        Название города из таблицы или None, если его координат нет.
+        """
+        return self.titles.get(city_key(city))
+
+    def missing(self, cities):
+        """
+        Названия из cities, для которых в таблице нет координат.
+        """
+        return [city for city in cities if self.title(city) is None]
+
+    def within(self, center, radius_km):
+        """
+        Ключи городов не дальше radius_km от center (не больше max_radius).
+        Пустой список, если центра нет в таблице.
+        """
+        key = city_key(center)
+        distances = self._distances.get(key)
+        if distances is None:
+            return []
+        end = bisect.bisect_right(distances, min(radius_km, self.max_radius))
+        return self._neighbours[key][:end]
+
+    def covered(self, value):
+        """
+        Ключи городов, которые покрывает значение фильтра "центр|радиус".
+        """
+        parsed = parse_radius(value)
+        return self.within(*parsed) if parsed else []
+
+
+geo_index = GeoIndex(CITY_COORDINATES)
@@ -1,9 +1,10 @@
 # handlers.py
 import logging
 import json
-import aiohttp
 import os
 import asyncio
+import hashlib
+import html
 from telegram import (
     Update,
     InlineKeyboardButton,
@@ -19,20 +20,26 @@ from telegram.ext import (
     filters,
     ConversationHandler
 )
-from config import BEARER_TOKEN
-from db import (
+import catalog
+import outbox
+import upstream
+from geo import MAX_RADIUS_KM, parse_radius, parse_radius_input
+from taxonomy import CATEGORIES, CATEGORY_TITLES, category_of
+from db_async import (
     init_db,
     add_user,
     get_user_by_telegram_id,
     delete_user_by_telegram_id,
     add_request,
-    init_notification_items_for_user,
     get_notification_items,
+    set_notification_item,
+    toggle_notification_item,
     toggle_notification_item_by_id,
-    get_users_for_notification,
-    get_telegram_id_by_user_id,
-    get_all_requests,
-    get_connection
+    add_radius_subscription,
+    remove_radius_subscription,
+    enqueue_notifications,
+    get_orders_page,
+    search_orders
 )
 from payment_store import generate_unique_hash, valid_payment_hashes, payment_links
 
@@ -43,7 +50,7 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-MAIN_MENU, REQUEST_INPUT, SEARCH_INPUT = range(3)
+MAIN_MENU, REQUEST_INPUT, SEARCH_INPUT, RADIUS_INPUT = range(4)
 
 # --- ссылки на каналы / чаты и поддержку ---
 # --- ссылки на каналы / чаты и поддержку ---
@@ -128,39 +135,28 @@ def build_request_keyboard(user_data):
 
 def build_notifications_menu():
     keyboard = [
+        [InlineKeyboardButton("Настроить категории", callback_data="notif_categories")],
         [InlineKeyboardButton("Настроить материалы", callback_data="notif_materials")],
         [InlineKeyboardButton("Настроить города",   callback_data="notif_cities")],
+        [InlineKeyboardButton("Города в радиусе",   callback_data="notif_radius")],
         [InlineKeyboardButton("🔍 Посмотреть все заявки", callback_data="notif_view_requests")],
         [InlineKeyboardButton("🔙 Назад", callback_data="notif_back_main")]
     ]
     return InlineKeyboardMarkup(keyboard)
 
 async def fetch_materials_and_cities():
-    logger.warning("fetch_materials_and_cities called")
-    url = "https://scraptraffic.com/api/telegram_bot_external/materials_and_cities"
-    headers = {"Authorization": f"Bearer {BEARER_TOKEN}"}
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as resp:
-            raw_data = await resp.json()
-            logger.warning("Raw materials_and_cities data: %s", raw_data)
-            materials_list = [m["title"] for m in raw_data.get("materials", [])
-                              if isinstance(m, dict) and "title" in m]
-            cities_list = [c["title"] for c in raw_data.get("cities", [])
-                           if isinstance(c, dict) and "title" in c]
-            result = {"materials": materials_list, "cities": cities_list}
-            logger.warning("Transformed materials_and_cities: %s", result)
-            return result
-
-def add_notification_item(user_id: int, filter_type: str, value: str):
-    logger.warning("add_notification_item user_id=%s filter_type=%s value=%s", user_id, filter_type, value)
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO notification_filters (user_id, filter_type, value, is_enabled) VALUES (?, ?, ?, ?)",
-        (user_id, filter_type, value, 1)
-    )
-    conn.commit()
-    conn.close()
+    """
+    Каталог материалов и городов из кэша (catalog.py); сеть — только
+    при первом обращении, дальше обновление идёт в фоне.
+    """
+    return await catalog.cache.get()
+
+def title_tag(title):
+    """
+    Короткий отпечаток названия для callback_data: по нему обработчик
+    проверяет, что позиция в каталоге всё ещё указывает на то же название.
+    """
+    return hashlib.sha1(title.encode("utf-8")).hexdigest()[:8]
 
 async def build_filter_keyboard(user_id, filter_type, page=1):
     data = await fetch_materials_and_cities()
@@ -171,18 +167,19 @@ async def build_filter_keyboard(user_id, filter_type, page=1):
     start = (page - 1) * items_per_page
     end = start + items_per_page
     subitems = items[start:end]
-    db_items = get_notification_items(user_id, filter_type)
-    db_dict = {val: (fid, is_enabled) for fid, val, is_enabled in db_items}
+    # в БД хранятся только отключённые значения, всё остальное включено
+    db_items = await get_notification_items(user_id, filter_type)
+    disabled = {val for _fid, val, is_enabled in db_items if not is_enabled}
+    disabled_categories = await get_disabled_categories(user_id) if filter_type == "material" else set()
     keyboard = []
-    for item in subitems:
-        if item in db_dict:
-            fid, is_enabled = db_dict[item]
-            icon = "✅" if is_enabled == 1 else "❌"
-            data_cb = f"tn|{fid}|{page}|{filter_type}"
-        else:
-            icon = "❌"
-            data_cb = f"add_filter|{item}|{page}|{filter_type}"
+    for pos, item in enumerate(subitems, start=start):
+        icon = "❌" if item in disabled else "✅"
+        # позиция в каталоге и отпечаток вместо названия: callback_data ограничен 64 байтами
+        data_cb = f"tf|{filter_type}|{page}|{pos}|{title_tag(item)}"
         button_text = f"{icon} {item}"
+        if category_of(item) in disabled_categories:
+            # материал отключён категорией, его собственная строка фильтра ничего не меняет
+            button_text = f"❌ {item} (категория отключена)"
         keyboard.append([InlineKeyboardButton(button_text, callback_data=data_cb)])
     nav_btns = []
     if page > 1:
@@ -194,129 +191,136 @@ async def build_filter_keyboard(user_id, filter_type, page=1):
     keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="notif_back")])
     return InlineKeyboardMarkup(keyboard)
 
-async def fetch_orders():
-    logger.warning("fetch_orders called")
-    orders_url = "https://scraptraffic.com/api/telegram_bot_external/orders"
-    headers = {"Authorization": f"Bearer {BEARER_TOKEN}"}
-    async with aiohttp.ClientSession() as session:
-        async with session.get(orders_url, headers=headers) as resp:
-            data = await resp.json()
-            logger.warning("fetch_orders received %s items", len(data))
-            return data
+async def get_disabled_categories(user_id):
+    """
+    Ключи категорий, которые пользователь отключил.
+    """
+    db_items = await get_notification_items(user_id, "category")
+    return {val for _fid, val, is_enabled in db_items if not is_enabled}
+
+async def build_category_keyboard(user_id):
+    """
+    Категории материалов (taxonomy.CATEGORIES): отключённая категория
+    отключает все свои материалы одной строкой фильтра.
+    """
+    disabled = await get_disabled_categories(user_id)
+    counts = {}
+    for key in catalog.cache.categories.values():
+        counts[key] = counts.get(key, 0) + 1
+    keyboard = []
+    for key, title, _stems in CATEGORIES:
+        icon = "❌" if key in disabled else "✅"
+        keyboard.append([InlineKeyboardButton(f"{icon} {title} ({counts.get(key, 0)})",
+                                              callback_data=f"tcat|{key}")])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="notif_back")])
+    return InlineKeyboardMarkup(keyboard)
+
+RADIUS_MENU_TEXT = (
+    "📍 Заявки только из городов в радиусе от выбранных.\n"
+    "Пока радиусов нет, приходят заявки из всех городов.\n"
+    "Заявки без города или из города, которого нет в нашем справочнике, "
+    "приходят независимо от радиусов."
+)
+
+async def build_radius_keyboard(user_id):
+    """
+    Подписки по радиусу (geo.py): кнопка у каждой удаляет её.
+    """
+    db_items = await get_notification_items(user_id, "radius")
+    keyboard = []
+    for filter_id, value, _is_enabled in db_items:
+        parsed = parse_radius(value)
+        if parsed:
+            center, radius_km = parsed
+            keyboard.append([InlineKeyboardButton(f"❌ {center} — {radius_km} км",
+                                                  callback_data=f"rr|{filter_id}")])
+    keyboard.append([InlineKeyboardButton("➕ Добавить радиус", callback_data="radius_add")])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="notif_back")])
+    return InlineKeyboardMarkup(keyboard)
 
 async def post_new_order(order_data: dict) -> dict:
     logger.warning("post_new_order called with: %s", order_data)
-    url = "https://scraptraffic.com/api/telegram_bot_external/emulate_new_order"
-    headers = {"Authorization": f"Bearer {BEARER_TOKEN}"}
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers, params=order_data) as resp:
-            try:
-                data = await resp.json()
-                logger.warning("post_new_order success: %s", data)
-            except Exception as e:
-                text = await resp.text()
-                logger.error(f"Error decoding JSON: {e}. Response text: {text}")
-                data = {"error": "Не удалось создать заявку"}
-            return data
-
-async def build_requests_page_text(search, page, page_size=10):
-    logger.warning("build_requests_page_text called, search=%s page=%s", search, page)
-    orders = await fetch_orders()
-    transformed = []
-    for order in orders:
-        transformed.append((
-            order.get("order_id"),
-            "Новая заявка",
-            order.get("text_material", ""),
-            order.get("text_volume", ""),
-            order.get("text_city", ""),
-            order.get("comment", ""),
-            order.get("date", "")
-        ))
+    async with upstream.client.request("GET", "emulate_new_order", params=order_data) as resp:
+        try:
+            data = await resp.json()
+            logger.warning("post_new_order success: %s", data)
+        except Exception as e:
+            text = await resp.text()
+            logger.error(f"Error decoding JSON: {e}. Response text: {text}")
+            data = {"error": "Не удалось создать заявку"}
+        return data
+
+async def build_requests_page_text(search, page_cursor="", page_size=10):
+    """
+    Страница заявок из локальной копии заказов (order_sync.py):
+    с поиском — по индексу FTS5, без него — по дате, новые сверху.
+    """
+    logger.warning("build_requests_page_text called, search=%s cursor=%s", search, page_cursor)
     if search:
-        search_lower = search.lower()
-        filtered = [r for r in transformed if (
-            search_lower in str(r[0]).lower() or
-            search_lower in str(r[1]).lower() or
-            search_lower in (r[2] or "").lower() or
-            search_lower in (r[3] or "").lower() or
-            search_lower in (r[4] or "").lower() or
-            search_lower in (r[5] or "").lower() or
-            search_lower in (r[6] or "").lower()
-        )]
+        found, prev_cursor, next_cursor = await search_orders(search, page_cursor, page_size)
     else:
-        filtered = transformed
-    total = len(filtered)
-    start = (page - 1) * page_size
-    end = start + page_size
-    page_reqs = filtered[start:end]
-    text = "<b>Все заявки:</b>\n\n" + format_requests_list(page_reqs)
-    has_prev = page > 1
-    has_next = end < total
-    logger.warning("build_requests_page_text: total=%s, page_reqs=%s", total, len(page_reqs))
-    return text, has_prev, has_next
-
-def build_requests_page_keyboard(page, has_prev, has_next, search):
-    logger.warning("build_requests_page_keyboard: page=%s has_prev=%s has_next=%s search=%s",
-                   page, has_prev, has_next, search)
+        found, prev_cursor, next_cursor = await get_orders_page(page_cursor, page_size)
+    text = "<b>Все заявки:</b>\n\n" + format_requests_list(found)
+    logger.warning("build_requests_page_text: page_reqs=%s", len(found))
+    return text, prev_cursor, next_cursor
+
+def build_requests_page_keyboard(prev_cursor, next_cursor, search):
+    logger.warning("build_requests_page_keyboard: prev=%s next=%s search=%s",
+                   prev_cursor, next_cursor, search)
     buttons = []
     nav_buttons = []
-    if has_prev:
-        nav_buttons.append(InlineKeyboardButton("⬅️", callback_data=f"view_req|{page-1}|{search}"))
-    if has_next:
-        nav_buttons.append(InlineKeyboardButton("➡️", callback_data=f"view_req|{page+1}|{search}"))
+    if prev_cursor:
+        nav_buttons.append(InlineKeyboardButton("⬅️", callback_data=f"view_req|{prev_cursor}|{search}"))
+    if next_cursor:
+        nav_buttons.append(InlineKeyboardButton("➡️", callback_data=f"view_req|{next_cursor}|{search}"))
     if nav_buttons:
         buttons.append(nav_buttons)
     buttons.append([InlineKeyboardButton("🔍 Поиск", callback_data="view_req_search")])
     buttons.append([InlineKeyboardButton("🔙 Назад", callback_data="notif_back")])
     return InlineKeyboardMarkup(buttons)
 
-def format_requests_list(requests):
-    if not requests:
+def format_requests_list(orders):
+    if not orders:
         return "Заявок пока нет."
     lines = []
-    for r in requests:
-        req_id, req_type, material, qty, city, info, created_at = r
+    for o in orders:
         lines.append(
-            f"#{req_id}: [{req_type}] {material}, {qty}, {city}\n"
-            f"   Доп: {info}\n"
-            f"   Дата: {created_at}\n"
+            f"#{o.order_id}: [Новая заявка] {o.material}, {o.quantity}, {o.city}\n"
+            f"   Доп: {o.comment}\n"
+            f"   Дата: {o.date}\n"
         )
     return "\n".join(lines)
 
 async def notify_users_about_new_request(context: ContextTypes.DEFAULT_TYPE, creator_user_id: int, req: dict):
     logger.warning("notify_users_about_new_request called for user_id=%s req=%s", creator_user_id, req)
-    material = req["material"]
-    city = req["city"]
-    matching_user_ids = get_users_for_notification(material, city)
+    # материал и город введены текстом — приводим к названиям каталога, как в фильтрах
+    normalizer = await catalog.cache.get_normalizer()
+    material = normalizer.material(req["material"])
+    city = normalizer.city(req["city"])
+    # поля введены пользователем: "<" в тексте сломал бы разметку сообщения
+    shown = {key: html.escape(str(value), quote=False)
+             for key, value in dict(req, material=material, city=city).items()}
     notification_text = (
         f"🔔 <b>Новая заявка</b>\n"
-        f"Тип: {req['type']}\n"
-        f"Материал: {material}\n"
-        f"Количество: {req['quantity']}\n"
-        f"Город: {city}\n"
-        f"Доп. инфо: {req['info']}\n\n"
+        f"Тип: {shown['type']}\n"
+        f"Материал: {shown['material']}\n"
+        f"Количество: {shown['quantity']}\n"
+        f"Город: {shown['city']}\n"
+        f"Доп. инфо: {shown['info']}\n\n"
         "Для просмотра откройте меню бота."
     )
-    for uid in matching_user_ids:
-        if uid == creator_user_id:
-            continue
-        tg_id = get_telegram_id_by_user_id(uid)
-        if tg_id:
-            try:
-                await context.bot.send_message(chat_id=tg_id, text=notification_text, parse_mode='HTML')
-            except Exception as e:
-                logger.error(f"Failed to send notification to user_id=%s (tg_id=%s): %s", uid, tg_id, e)
+    # строка для дайджеста бесплатных аккаунтов
+    summary = outbox.digest_item(material, req['quantity'], city, f"{req['type']}. {req['info']}")
+    queued = await enqueue_notifications(material, city, notification_text, parse_mode='HTML',
+                                         exclude_user_id=creator_user_id, summary=summary)
+    outbox.worker.wake()
+    logger.warning("notify_users_about_new_request queued %s notifications", queued)
 
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
     logger.warning("cmd_start called by user_id=%s, username=%s", user.id, user.username)
-    add_user(user.id, user.username)
-
-    # инициализация фильтров для нового пользователя
-    row = get_user_by_telegram_id(user.id)
-    if row:
-        init_notification_items_for_user(row[0])
+    # по умолчанию пользователь подписан на все материалы и города
+    await add_user(user.id, user.username)
 
     if update.message:
         # ---- СТРОКА ОЖИДАНИЯ (ОПЦИОНАЛЬНО)----
@@ -375,7 +379,7 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     user = query.from_user
     logger.warning("main_menu_callback: user_id=%s data=%s", user.id, data)
-    user_row = get_user_by_telegram_id(user.id)
+    user_row = await get_user_by_telegram_id(user.id)
     if not user_row:
         await query.answer("Вы не зарегистрированы. Введите /start.", show_alert=True)
         return ConversationHandler.END
@@ -455,7 +459,7 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     elif data == "menu_notifications":
         try:
             await query.message.edit_text(
-                "🔔 Вы можете отфильтровать получение заявок по материалам и городам.\n"
+                "🔔 Вы можете отфильтровать получение заявок по категориям, материалам и городам.\n"
                 "По умолчанию уведомления приходят по всем материалам и городам.",
                 reply_markup=build_notifications_menu(),
                 parse_mode='HTML'
@@ -487,7 +491,7 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return MAIN_MENU
 
     elif data == "menu_logout":
-        delete_user_by_telegram_id(user.id)
+        await delete_user_by_telegram_id(user.id)
         try:
             await query.message.delete()
         except Exception as e:
@@ -514,6 +518,54 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return MAIN_MENU
 
+    elif data == "notif_categories":
+        items_kb = await build_category_keyboard(user_id)
+        try:
+            await query.message.edit_text(
+                "🔔 Настройка категорий материалов:",
+                reply_markup=items_kb,
+                parse_mode='HTML'
+            )
+        except Exception as e:
+            logger.error(f"edit_text error: {e}")
+        await query.answer()
+        return MAIN_MENU
+
+    elif data == "notif_radius":
+        items_kb = await build_radius_keyboard(user_id)
+        try:
+            await query.message.edit_text(RADIUS_MENU_TEXT, reply_markup=items_kb, parse_mode='HTML')
+        except Exception as e:
+            logger.error(f"edit_text error: {e}")
+        await query.answer()
+        return MAIN_MENU
+
+    elif data == "radius_add":
+        try:
+            await query.message.edit_text(
+                f"Введите город и радиус в км (до {MAX_RADIUS_KM}), например: <b>Екатеринбург 300</b>",
+                parse_mode='HTML'
+            )
+        except Exception as e:
+            logger.error(f"edit_text error: {e}")
+        await query.answer()
+        return RADIUS_INPUT
+
+    elif data.startswith("rr|"):
+        try:
+            filter_id = int(data.split("|", 1)[1])
+        except ValueError:
+            await query.answer("Непонятный формат callback_data (rr|).", show_alert=True)
+            return MAIN_MENU
+        removed = await remove_radius_subscription(user_id, filter_id)
+        new_kb = await build_radius_keyboard(user_id)
+        try:
+            await query.message.edit_reply_markup(new_kb)
+        except Exception as e:
+            logger.error(f"edit_reply_markup error: {e}")
+        await query.answer("Радиус удалён." if removed else "Радиус уже удалён.")
+        return MAIN_MENU
+
     elif data == "notif_materials":
         items_kb = await build_filter_keyboard(user_id, "material", page=1)
         try:
@@ -541,8 +593,8 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return MAIN_MENU
 
     elif data == "notif_view_requests":
-        text, has_prev, has_next = await build_requests_page_text("", 1)
-        kb = build_requests_page_keyboard(1, has_prev, has_next, "")
+        text, prev_cursor, next_cursor = await build_requests_page_text("")
+        kb = build_requests_page_keyboard(prev_cursor, next_cursor, "")
         try:
             await query.message.edit_text(text, parse_mode='HTML', reply_markup=kb)
         except Exception as e:
@@ -551,15 +603,13 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return MAIN_MENU
 
     elif data.startswith("view_req|"):
-        parts = data.split("|")
+        # view_req|<курсор>|<поиск>; у старых кнопок вместо курсора номер
+        # страницы — parse_cursor превратит его в первую страницу
+        parts = data.split("|", 2)
         if len(parts) == 3:
-            try:
-                page = int(parts[1])
-            except ValueError:
-                page = 1
-            search = parts[2]
-            text, has_prev, has_next = await build_requests_page_text(search, page)
-            kb = build_requests_page_keyboard(page, has_prev, has_next, search)
+            page_cursor, search = parts[1], parts[2]
+            text, prev_cursor, next_cursor = await build_requests_page_text(search, page_cursor)
+            kb = build_requests_page_keyboard(prev_cursor, next_cursor, search)
             try:
                 await query.message.edit_text(text, parse_mode='HTML', reply_markup=kb)
             except Exception as e:
@@ -584,7 +634,7 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     elif data == "notif_back":
         try:
             await query.message.edit_text(
-                "🔔 Вы можете отфильтровать получение заявок по материалам и городам.\n"
+                "🔔 Вы можете отфильтровать получение заявок по категориям, материалам и городам.\n"
                 "По умолчанию уведомления приходят по всем материалам и городам.",
                 reply_markup=build_notifications_menu(),
                 parse_mode='HTML'
@@ -745,6 +795,64 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await query.answer("Непонятная команда req_.", show_alert=True)
             return MAIN_MENU
 
+    elif data.startswith("tf|"):
+        parts = data.split("|")
+        # кнопки старого формата, без отпечатка названия, тоже просто перерисовываем
+        if len(parts) in (4, 5):
+            _, filter_type, page_str, pos_str = parts[:4]
+            tag = parts[4] if len(parts) == 5 else None
+            try:
+                page = int(page_str)
+                pos = int(pos_str)
+            except ValueError:
+                await query.answer("Непонятный формат callback_data (tf|).", show_alert=True)
+                return MAIN_MENU
+            catalog_data = await fetch_materials_and_cities()
+            items = catalog_data.get("materials" if filter_type == "material" else "cities", [])
+            if not 0 <= pos < len(items) or title_tag(items[pos]) != tag:
+                # каталог обновился после показа клавиатуры: позиция указывает
+                # на другое название, переключать его нельзя
+                try:
+                    await query.message.edit_reply_markup(await build_filter_keyboard(user_id, filter_type, page))
+                except Exception as e:
+                    logger.error(f"edit_reply_markup error: {e}")
+                await query.answer("Список обновился, попробуйте ещё раз.", show_alert=True)
+                return MAIN_MENU
+            value = items[pos]
+            category = category_of(value) if filter_type == "material" else None
+            if category is not None and category in await get_disabled_categories(user_id):
+                await query.answer(f"'{value}' входит в отключённую категорию "
+                                   f"{CATEGORY_TITLES[category]}. Включите её в «Настроить категории».",
+                                   show_alert=True)
+                return MAIN_MENU
+            enabled = await toggle_notification_item(user_id, filter_type, value)
+            new_kb = await build_filter_keyboard(user_id, filter_type, page)
+            try:
+                await query.message.edit_reply_markup(new_kb)
+            except Exception as e:
+                logger.error(f"edit_reply_markup error: {e}")
+            await query.answer(f"'{value}' {'включён' if enabled else 'отключён'}.")
+            return MAIN_MENU
+        else:
+            await query.answer("Непонятный формат callback_data (tf|).", show_alert=True)
+            return MAIN_MENU
+
+    elif data.startswith("tcat|"):
+        key = data.split("|", 1)[1]
+        if key not in CATEGORY_TITLES:
+            await query.answer("Непонятный формат callback_data (tcat|).", show_alert=True)
+            return MAIN_MENU
+        enabled = await toggle_notification_item(user_id, "category", key)
+        new_kb = await build_category_keyboard(user_id)
+        try:
+            await query.message.edit_reply_markup(new_kb)
+        except Exception as e:
+            logger.error(f"edit_reply_markup error: {e}")
+        await query.answer(f"'{CATEGORY_TITLES[key]}' {'включена' if enabled else 'отключена'}.")
+        return MAIN_MENU
+
+    # Кнопки add_filter| и tn| остались в сообщениях, отправленных до перехода
+    # на разреженное хранение фильтров.
     elif data.startswith("add_filter|"):
         parts = data.split("|", 3)
         if len(parts) == 4:
@@ -753,7 +861,7 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 page = int(page_str)
             except:
                 page = 1
-            add_notification_item(user_id, filter_type, value)
+            await set_notification_item(user_id, filter_type, value, True)
             new_kb = await build_filter_keyboard(user_id, filter_type, page)
             try:
                 await query.message.edit_reply_markup(new_kb)
@@ -771,7 +879,7 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             _, filter_id_str, page_str, filter_type = parts
             filter_id = int(filter_id_str)
             page = int(page_str)
-            toggle_notification_item_by_id(user_id, filter_id)
+            await toggle_notification_item_by_id(user_id, filter_id)
             new_kb = await build_filter_keyboard(user_id, filter_type, page)
             try:
                 await query.message.edit_reply_markup(new_kb)
@@ -841,11 +949,36 @@ async def request_field_input(update: Update, context: ContextTypes.DEFAULT_TYPE
     await update.message.reply_text(summary, reply_markup=kb, parse_mode='HTML')
     return MAIN_MENU
 
+async def radius_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    logger.warning("radius_input called with text=%s", update.message.text)
+    parsed = parse_radius_input(update.message.text)
+    if not parsed:
+        await update.message.reply_text(
+            "⚠️ Не понял. Введите город и радиус в км, например: <b>Екатеринбург 300</b>",
+            parse_mode='HTML'
+        )
+        return RADIUS_INPUT
+    user_row = await get_user_by_telegram_id(update.effective_user.id)
+    if not user_row:
+        await update.message.reply_text("⚠️ Пользователь не найден. Введите /start.", parse_mode='HTML')
+        return MAIN_MENU
+    center, radius_km = parsed
+    value = await add_radius_subscription(user_row[0], center, radius_km)
+    if value is None:
+        await update.message.reply_text(
+            f"⚠️ Нет координат города «{center}». Попробуйте ближайший крупный город.",
+            parse_mode='HTML'
+        )
+        return RADIUS_INPUT
+    kb = await build_radius_keyboard(user_row[0])
+    await update.message.reply_text(RADIUS_MENU_TEXT, reply_markup=kb, parse_mode='HTML')
+    return MAIN_MENU
+
 async def search_requests_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.warning("search_requests_input called with text=%s", update.message.text)
     search_query = update.message.text.strip()
-    text, has_prev, has_next = await build_requests_page_text(search_query, 1)
-    kb = build_requests_page_keyboard(1, has_prev, has_next, search_query)
+    text, prev_cursor, next_cursor = await build_requests_page_text(search_query)
+    kb = build_requests_page_keyboard(prev_cursor, next_cursor, search_query)
     await update.message.reply_text(text, reply_markup=kb, parse_mode='HTML')
     return MAIN_MENU
 
@@ -865,6 +998,10 @@ main_flow_handler = ConversationHandler(
         ],
         SEARCH_INPUT: [
             MessageHandler(filters.TEXT & ~filters.COMMAND, search_requests_input)
+        ],
+        RADIUS_INPUT: [
+            CallbackQueryHandler(main_menu_callback),
+            MessageHandler(filters.TEXT & ~filters.COMMAND, radius_input),
         ]
     },
     fallbacks=[CommandHandler('cancel', cmd_start)],
@@ -874,7 +1011,7 @@ main_flow_handler = ConversationHandler(
 from telegram.ext import Application
 
 async def run_bot():
-    init_db()
+    await init_db()
     app = Application.builder().token("YOUR_BOT_TOKEN_HERE").build()
     app.add_handler(main_flow_handler)
     app.add_error_handler(error_handler)
@@ -1,20 +1,34 @@
 # index.py
 import logging
 import asyncio
+import html
+import json
 import nest_asyncio
 import os
 from aiohttp import web
 from telegram.ext import ApplicationBuilder
 from config import TELEGRAM_BOT_TOKEN, BEARER_TOKEN
-from db import init_db
+from db_async import (
+    init_db,
+    run_migrations,
+    ingest_orders,
+    get_outbox_stats,
+    shutdown as shutdown_db
+)
 from handlers import (
     main_flow_handler,
     error_handler,
-    get_users_for_notification,
-    get_telegram_id_by_user_id,
     fetch_materials_and_cities
 )
 from payment_store import valid_payment_hashes, payment_links, generate_unique_hash
+import catalog
+from admission import AdmissionControl, RouteLimit, body_stream
+from dispatcher import dispatcher
+import order_sync
+import outbox
+import upstream
+from orders import Order, idempotency_key
+from upstream import iter_json_array
 
 nest_asyncio.apply()
 
@@ -31,10 +45,19 @@ logging.getLogger("h11").setLevel(logging.WARNING)
 
 app_telegram = None
 
+async def prepare_db():
+    logger.info("Инициализация базы данных...")
+    await init_db()
+    applied = await run_migrations()
+    if applied:
+        logger.info("Применены миграции схемы: %s", applied)
+
+
 async def start_bot():
     global app_telegram
-    logger.info("Инициализация базы данных...")
-    init_db()
+    await upstream.client.start()
+    await catalog.cache.warm_up()
+    sync_task = asyncio.create_task(order_sync.worker.run())
 
     logger.info("Создание приложения Telegram...")
     app_telegram = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
@@ -46,6 +69,8 @@ async def start_bot():
     except Exception as e:
         logger.error("Error deleting webhook: %s", e)
     
+    outbox_task = asyncio.create_task(outbox.worker.run(app_telegram.bot))
+
     # Add handlers once after webhook deletion
     app_telegram.add_handler(main_flow_handler)
     app_telegram.add_error_handler(error_handler)
@@ -58,7 +83,53 @@ async def start_bot():
     logger.info("Current valid_payment_hashes: %s", valid_payment_hashes)
 
     logger.info("Запуск Telegram-бота. Нажмите Ctrl+C для остановки.")
-    await app_telegram.run_polling()
+    try:
+        await app_telegram.run_polling()
+    finally:
+        sync_task.cancel()
+        outbox_task.cancel()
+
+
+def order_notification(data, normalizer=None):
+    """
+    (material, city, текст уведомления, строка дайджеста) для заказа из вебхука.
+    material и city приводятся к названиям каталога (normalize.CatalogNormalizer),
+    чтобы совпасть с фильтрами подписчиков.
+    """
+    material = data.get("text_material", "не указан")
+    city = data.get("text_city", "не указан")
+    if normalizer is not None:
+        material, city = normalizer.material(material), normalizer.city(city)
+    new_order = {
+        "type": "новая заявка",
+        "material": material,
+        "quantity": data.get("text_volume", "не указано"),
+        "city": city,
+        "info": data.get("comment", "не указана")
+    }
+    # поля заказа — свободный текст: "<" в комментарии сломал бы разметку сообщения
+    shown = {key: html.escape(str(value), quote=False) for key, value in new_order.items()}
+    notification_text = (
+        f"🔔 <b>Новая заявка</b>\n"
+        f"Тип: {shown['type']}\n"
+        f"Материал: {shown['material']}\n"
+        f"Количество: {shown['quantity']}\n"
+        f"Город: {shown['city']}\n"
+        f"Доп. инфо: {shown['info']}\n\n"
+        "Для просмотра откройте меню бота."
+    )
+    # строка для дайджеста бесплатных аккаунтов
+    summary = outbox.digest_item(new_order['material'], new_order['quantity'], new_order['city'],
+                                 new_order['info'])
+    return new_order["material"], new_order["city"], notification_text, summary
+
+
+def order_entry(data, normalizer):
+    """
+    (ключ повтора, orders.Order или None, уведомление) для db.ingest_orders.
+    Заказ сразу попадает в локальную копию, не дожидаясь фоновой синхронизации.
+    """
+    return idempotency_key(data), Order.from_api(data), order_notification(data, normalizer)
 
 
 async def handle_new_order(request: web.Request):
@@ -70,39 +141,118 @@ async def handle_new_order(request: web.Request):
     try:
         data = await request.json()
         logger.info("handle_new_order received JSON: %s", data)
+    except web.HTTPRequestEntityTooLarge:
+        raise
     except Exception as e:
         logger.error("Ошибка при разборе JSON: %s", e)
         return web.json_response({"error": "Invalid JSON"}, status=400)
 
-    new_order = {
-        "type": "новая заявка",
-        "material": data.get("text_material", "не указан"),
-        "quantity": data.get("text_volume", "не указано"),
-        "city": data.get("text_city", "не указан"),
-        "info": data.get("comment", "не указана")
-    }
-    notification_text = (
-        f"🔔 <b>Новая заявка</b>\n"
-        f"Тип: {new_order['type']}\n"
-        f"Материал: {new_order['material']}\n"
-        f"Количество: {new_order['quantity']}\n"
-        f"Город: {new_order['city']}\n"
-        f"Доп. инфо: {new_order['info']}\n\n"
-        "Для просмотра откройте меню бота."
-    )
-    matching_user_ids = get_users_for_notification(new_order["material"], new_order["city"])
-    logger.info("handle_new_order matching_user_ids: %s", matching_user_ids)
+    normalizer = await catalog.cache.get_normalizer()
+    # рассылку отправит outbox.worker, вебхук отвечает сразу после постановки в очередь;
+    # повтор уже принятого заказа подтверждаем без подбора получателей и рассылки
+    fresh, queued = await ingest_orders([order_entry(data, normalizer)], parse_mode='HTML')
+    if not fresh:
+        logger.info("handle_new_order: duplicate %s", idempotency_key(data))
+        return web.json_response({"status": "duplicate"}, status=200)
+    outbox.worker.wake()
+    logger.info("handle_new_order queued %s notifications", queued)
+
+    return web.json_response({"status": "queued", "recipients": queued}, status=202)
+
+
+# Сколько заказов пакета /new_orders обрабатывается в одной транзакции
+NEW_ORDERS_CHUNK = 500
+
+NDJSON_TYPES = ("application/x-ndjson", "application/jsonl", "application/x-jsonlines")
+
+
+async def iter_request_orders(request: web.Request):
+    """
+    Заказы из тела запроса по мере чтения: JSON-массив или NDJSON
+    (по объекту в строке, Content-Type application/x-ndjson).
+    """
+    content = body_stream(request)
+    if request.content_type in NDJSON_TYPES:
+        async for line in content:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    else:
+        async for item in iter_json_array(content.iter_chunked(65536)):
+            yield item
 
-    for uid in matching_user_ids:
-        tg_id = get_telegram_id_by_user_id(uid)
-        if tg_id:
-            try:
-                logger.info("Sending new_order notification to tg_id=%s", tg_id)
-                await app_telegram.bot.send_message(chat_id=tg_id, text=notification_text, parse_mode='HTML')
-            except Exception as e:
-                logger.error("Failed to send notification to user_id=%s (tg_id=%s): %s", uid, tg_id, e)
 
-    return web.json_response({"status": "ok"})
+async def _ingest_orders(chunk):
+    """
+    Сохраняет и ставит в очередь ещё не принятые заказы части.
+    Возвращает (число новых заказов, число поставленных сообщений).
+    """
+    normalizer = await catalog.cache.get_normalizer()
+    return await ingest_orders([order_entry(data, normalizer) for data in chunk], parse_mode='HTML')
+
+
+async def handle_new_orders(request: web.Request):
+    """
+    Пакет заказов (повтор накопившихся у Scraptraffic): заказы сохраняются
+    и ставятся в очередь рассылки частями по NEW_ORDERS_CHUNK, получатели
+    подбираются один раз на пару (материал, город) в части. Уже принятые
+    заказы считаются в duplicates и не рассылаются повторно.
+    """
+    logger.info("handle_new_orders called")
+    auth = request.headers.get("Authorization", "")
+    if not auth.startswith("Bearer ") or auth.split(" ")[1] != BEARER_TOKEN:
+        logger.warning("Unauthorized in handle_new_orders")
+        return web.json_response({"error": "Unauthorized"}, status=401)
+    accepted = queued = skipped = duplicates = 0
+    chunk = []
+    error = None
+    try:
+        async for data in iter_request_orders(request):
+            if not isinstance(data, dict):
+                skipped += 1
+                continue
+            chunk.append(data)
+            if len(chunk) >= NEW_ORDERS_CHUNK:
+                fresh, chunk_queued = await _ingest_orders(chunk)
+                queued += chunk_queued
+                accepted += len(chunk)
+                duplicates += len(chunk) - fresh
+                chunk = []
+                outbox.worker.wake()
+    except ValueError as e:
+        logger.error("handle_new_orders: invalid body after %s orders: %s", accepted + len(chunk), e)
+        error = ("Invalid JSON", 400)
+    except web.HTTPRequestEntityTooLarge:
+        logger.error("handle_new_orders: body too large after %s orders", accepted + len(chunk))
+        error = ("Request body too large", 413)
+    # заказы, разобранные до ошибки в теле, принимаются: повтор пакета
+    # отправителем не разошлёт их второй раз (см. duplicates)
+    if chunk:
+        fresh, chunk_queued = await _ingest_orders(chunk)
+        queued += chunk_queued
+        accepted += len(chunk)
+        duplicates += len(chunk) - fresh
+    outbox.worker.wake()
+    logger.info("handle_new_orders accepted %s orders (%s duplicates), queued %s notifications",
+                accepted, duplicates, queued)
+    counts = {"orders": accepted, "duplicates": duplicates, "skipped": skipped, "recipients": queued}
+    if error is not None:
+        message, status = error
+        return web.json_response({"error": message, **counts}, status=status)
+    return web.json_response({"status": "queued", **counts}, status=202)
+
+
+# Допуск запросов к веб-серверу: у каждого вебхука свои слоты и очередь,
+# поэтому поток заказов не задерживает уведомления об оплате
+admission = AdmissionControl(
+    {
+        "/new_order": RouteLimit(concurrency=16, queue=256, max_body=64 * 1024),
+        "/new_orders": RouteLimit(concurrency=2, queue=4, max_body=64 * 1024 * 1024),
+        "/payment-notification": RouteLimit(concurrency=8, queue=64, max_body=16 * 1024),
+        "/bot-payment-test": RouteLimit(concurrency=8, queue=64, max_body=16 * 1024),
+    },
+    default=RouteLimit(concurrency=4, queue=16, max_body=1024 * 1024),
+)
 
 
 async def verify_payment_link(request: web.Request):
@@ -136,6 +286,8 @@ async def handle_payment_notification(request: web.Request):
     try:
         data = await request.json()
         logger.info("handle_payment_notification received JSON: %s", data)
+    except web.HTTPRequestEntityTooLarge:
+        raise
     except Exception as e:
         logger.error("Error parsing JSON: %s", e)
         return web.json_response({"error": "Invalid JSON"}, status=400)
@@ -173,12 +325,26 @@ async def handle_test_materials_cities(request: web.Request):
     return web.json_response(data)
 
 
+async def handle_test_upstream_metrics(request: web.Request):
+    return web.json_response({
+        "upstream": upstream.client.metrics(),
+        "catalog": catalog.cache.metrics(),
+        "order_sync": order_sync.worker.stats,
+        "dispatcher": dispatcher.metrics(),
+        "outbox": {**outbox.worker.stats, "queue": await get_outbox_stats()},
+        "admission": admission.metrics(),
+    })
+
+
 async def start_webserver():
-    web_app = web.Application()
+    await upstream.client.start()
+    web_app = web.Application(middlewares=[admission.middleware])
     web_app.router.add_post("/new_order", handle_new_order)
+    web_app.router.add_post("/new_orders", handle_new_orders)
     web_app.router.add_get("/bot-payment-test", verify_payment_link)
     web_app.router.add_post("/payment-notification", handle_payment_notification)
     web_app.router.add_get("/test/materials_cities", handle_test_materials_cities)
+    web_app.router.add_get("/test/upstream_metrics", handle_test_upstream_metrics)
     runner = web.AppRunner(web_app)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", 5002)
@@ -187,7 +353,13 @@ async def start_webserver():
 
 
 async def main():
-    await asyncio.gather(start_webserver(), start_bot())
+    try:
+        # схема готова до того, как вебхуки и бот начнут обращаться к БД
+        await prepare_db()
+        await asyncio.gather(start_webserver(), start_bot())
+    finally:
+        await upstream.client.close()
+        shutdown_db()
 
 
 if __name__ == "__main__":
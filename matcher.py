@@ -0,0 +1,366 @@
+"""
+matcher.py
+Индексы подписок в памяти. По умолчанию каждый пользователь получает заявки
+по всем материалам и городам; в notification_filters хранятся только
+отключённые значения. Индекс держит множество всех пользователей и для
+каждого материала и города — множество тех, кто его отключил. Подбор
+получателей новой заявки — разность этих множеств, без обращения к БД.
+
+Категория (filter_type 'category', taxonomy.py) отключает все свои материалы
+одной строкой фильтра. Категория материала — функция его названия
+(taxonomy.category_of); индекс запоминает её для каждого материала, так что
+подбор — на один поиск в словаре больше и не зависит от загрузки каталога.
+
+Подписка по радиусу (filter_type 'radius', значение "центр|км", geo.py),
+наоборот, включённая: пользователь с такими подписками получает заявки
+только из городов внутри своих кругов. Круг разворачивается в города
+при записи подписки, и индекс держит для каждого города тех, чьи круги
+его покрывают, — при подборе город заказа ищется в словаре, расстояния
+не считаются. Заказ из города, которого нет в таблице координат (или без
+города), круги не ограничивают: расстояние до него неизвестно, и такой
+заказ получают все, кто не отключил его материал и город.
+
+SubscriptionIndex хранит обычные множества, BitsetIndex — битовые карты
+над плотными внутренними номерами пользователей (компактнее и быстрее
+на сотнях тысяч подписчиков). Выбор — через create_index().
+"""
+
+import threading
+from functools import lru_cache
+from itertools import compress
+
+from geo import city_key, geo_index
+from taxonomy import category_of
+
+FILTER_TYPES = ("material", "city", "category")
+RADIUS = "radius"
+
+# Категория материала с запоминанием: материалы заказов приведены
+# к названиям каталога, поэтому различных значений немного
+_category_of = lru_cache(maxsize=10000)(category_of)
+
+
+def _coverage(circles):
+    """
+    Ключи городов, покрытых хотя бы одним кругом "центр|км" из circles.
+    """
+    keys = set()
+    for value in circles:
+        keys.update(geo_index.covered(value))
+    return keys
+
+
+class SubscriptionIndex:
+    """
+    Множество всех user_id и инвертированный индекс value → {user_id}
+    отключённых фильтров по типам. Заполняется один раз из БД (load)
+    и дальше обновляется точечно функциями db.py после каждой записи.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._users = set()
+            self._excluded = {ft: {} for ft in FILTER_TYPES}
+            self._reset_circles()
+            self.loaded = False
+
+    def _reset_circles(self):
+        self._circles = {}
+        self._covering = {}
+        self._restricted = set()
+
+    def _set_circle(self, user_id, value, enabled):
+        """
+        Добавляет или убирает круг пользователя и переносит разницу
+        покрытия в _covering (город → {user_id}).
+        """
+        circles = self._circles.get(user_id, set())
+        before = _coverage(circles)
+        circles = circles | {value} if enabled else circles - {value}
+        after = _coverage(circles)
+        for key in before - after:
+            users = self._covering[key]
+            users.discard(user_id)
+            if not users:
+                del self._covering[key]
+        for key in after - before:
+            self._covering.setdefault(key, set()).add(user_id)
+        if circles:
+            self._circles[user_id] = circles
+            self._restricted.add(user_id)
+        else:
+            self._circles.pop(user_id, None)
+            self._restricted.discard(user_id)
+
+    def load(self, fetch):
+        """
+        fetch() возвращает (user_ids, rows), где rows — (user_id, filter_type, value)
+        отключённых фильтров и подписок по радиусу. Чтение идёт под блокировкой
+        индекса: запись, закоммиченная параллельно, либо попадёт в снимок,
+        либо применится к индексу уже после загрузки.
+        """
+        with self._lock:
+            user_ids, rows = fetch()
+            excluded = {ft: {} for ft in FILTER_TYPES}
+            self._reset_circles()
+            for user_id, filter_type, value in rows:
+                if filter_type == RADIUS:
+                    self._set_circle(user_id, value, True)
+                    continue
+                by_value = excluded.get(filter_type)
+                if by_value is not None:
+                    by_value.setdefault(value, set()).add(user_id)
+            self._users = set(user_ids)
+            self._excluded = excluded
+            self.loaded = True
+
+    def add_user(self, user_id):
+        with self._lock:
+            if self.loaded:
+                self._users.add(user_id)
+
+    def set_enabled(self, user_id, filter_type, value, enabled):
+        with self._lock:
+            if self.loaded and filter_type == RADIUS:
+                self._set_circle(user_id, value, enabled)
+                return
+            by_value = self._excluded.get(filter_type)
+            if not self.loaded or by_value is None:
+                return
+            if not enabled:
+                by_value.setdefault(value, set()).add(user_id)
+            else:
+                users = by_value.get(value)
+                if users is not None:
+                    users.discard(user_id)
+                    if not users:
+                        del by_value[value]
+
+    def remove_user(self, user_id):
+        with self._lock:
+            if not self.loaded:
+                return
+            self._users.discard(user_id)
+            for value in list(self._circles.get(user_id, ())):
+                self._set_circle(user_id, value, False)
+            for by_value in self._excluded.values():
+                for value in [v for v, users in by_value.items() if user_id in users]:
+                    by_value[value].discard(user_id)
+                    if not by_value[value]:
+                        del by_value[value]
+
+    def match(self, material, city):
+        """
+        Возвращает отсортированный список user_id, не отключивших ни material,
+        ни его категорию, ни city, и чьи круги (если они есть) покрывают city.
+        Город не из таблицы координат круги не ограничивают.
+        """
+        key = city_key(city)
+        with self._lock:
+            no_material = self._excluded["material"].get(material, ())
+            no_category = self._excluded["category"].get(_category_of(material), ())
+            no_city = self._excluded["city"].get(city, ())
+            restricted = self._restricted if key in geo_index.titles else ()
+            covering = self._covering.get(key, ()) if restricted else ()
+            return sorted(uid for uid in self._users
+                          if uid not in no_material and uid not in no_category and uid not in no_city
+                          and (uid not in restricted or uid in covering))
+
+
+_BIT_SELECTORS = bytes.maketrans(b"01", b"\x00\x01")
+
+
+def _select_bits(bits, items):
+    """
+    Элементы items, чьи позиции установлены в bits. bin(), translate и compress
+    работают на C, так что Python не перебирает биты по одному.
+    """
+    selectors = bin(bits)[:1:-1].encode("ascii").translate(_BIT_SELECTORS)
+    return compress(items, selectors)
+
+
+class BitsetIndex:
+    """
+    Битовая карта всех пользователей плюс по карте отключивших на каждый
+    материал и город (int Python над плотными номерами пользователей).
+    Подбор получателей — all & ~(material | category | city), из которых
+    пользователи с кругами (restricted) остаются, только если круг покрывает город.
+    Номера выдаются при первом появлении пользователя и переиспользуются
+    после удаления, чтобы карты не разрастались.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._all = 0
+            self._bitmaps = {ft: {} for ft in FILTER_TYPES}
+            self._slot_of = {}
+            self._user_at = []
+            self._free_slots = []
+            self._reset_circles()
+            self.loaded = False
+
+    def _reset_circles(self):
+        self._circles = {}
+        self._covering = {}
+        self._restricted = 0
+
+    def _set_circle(self, user_id, value, enabled):
+        """
+        Добавляет или убирает круг пользователя и переносит разницу
+        покрытия в _covering (город → битовая карта).
+        """
+        slot = self._slot(user_id)
+        bit = 1 << slot
+        circles = self._circles.get(user_id, set())
+        before = _coverage(circles)
+        circles = circles | {value} if enabled else circles - {value}
+        after = _coverage(circles)
+        for key in before - after:
+            bits = self._covering[key] & ~bit
+            if bits:
+                self._covering[key] = bits
+            else:
+                del self._covering[key]
+        for key in after - before:
+            self._covering[key] = self._covering.get(key, 0) | bit
+        if circles:
+            self._circles[user_id] = circles
+            self._restricted |= bit
+        else:
+            self._circles.pop(user_id, None)
+            self._restricted &= ~bit
+
+    def _slot(self, user_id):
+        slot = self._slot_of.get(user_id)
+        if slot is None:
+            if self._free_slots:
+                slot = self._free_slots.pop()
+                self._user_at[slot] = user_id
+            else:
+                slot = len(self._user_at)
+                self._user_at.append(user_id)
+            self._slot_of[user_id] = slot
+        return slot
+
+    @staticmethod
+    def _bits_of(slots):
+        bits = 0
+        for slot in slots:
+            bits |= 1 << slot
+        return bits
+
+    def load(self, fetch):
+        """
+        fetch() возвращает (user_ids, rows), где rows — (user_id, filter_type, value)
+        отключённых фильтров и подписок по радиусу.
+        """
+        with self._lock:
+            self._slot_of = {}
+            self._user_at = []
+            self._free_slots = []
+            self._reset_circles()
+            user_ids, rows = fetch()
+            # Пользователи получают номера по порядку user_id, поэтому
+            # до первого переиспользования номеров match() почти не сортирует.
+            all_bits = self._bits_of(self._slot(uid) for uid in sorted(user_ids))
+            slots = {ft: {} for ft in FILTER_TYPES}
+            for user_id, filter_type, value in rows:
+                if filter_type == RADIUS:
+                    self._set_circle(user_id, value, True)
+                    continue
+                by_value = slots.get(filter_type)
+                if by_value is not None:
+                    by_value.setdefault(value, []).append(self._slot(user_id))
+            self._all = all_bits
+            self._bitmaps = {ft: {value: self._bits_of(value_slots)
+                                  for value, value_slots in by_value.items()}
+                             for ft, by_value in slots.items()}
+            self.loaded = True
+
+    def add_user(self, user_id):
+        with self._lock:
+            if self.loaded:
+                self._all |= 1 << self._slot(user_id)
+
+    def set_enabled(self, user_id, filter_type, value, enabled):
+        with self._lock:
+            if self.loaded and filter_type == RADIUS:
+                self._set_circle(user_id, value, enabled)
+                return
+            by_value = self._bitmaps.get(filter_type)
+            if not self.loaded or by_value is None:
+                return
+            if not enabled:
+                by_value[value] = by_value.get(value, 0) | (1 << self._slot(user_id))
+            else:
+                slot = self._slot_of.get(user_id)
+                bits = by_value.get(value, 0)
+                if slot is None or not bits >> slot & 1:
+                    return
+                bits &= ~(1 << slot)
+                if bits:
+                    by_value[value] = bits
+                else:
+                    del by_value[value]
+
+    def remove_user(self, user_id):
+        with self._lock:
+            if user_id not in self._slot_of:
+                return
+            for value in list(self._circles.get(user_id, ())):
+                self._set_circle(user_id, value, False)
+            slot = self._slot_of.pop(user_id)
+            mask = ~(1 << slot)
+            self._all &= mask
+            for by_value in self._bitmaps.values():
+                for value in [v for v, bits in by_value.items() if bits >> slot & 1]:
+                    bits = by_value[value] & mask
+                    if bits:
+                        by_value[value] = bits
+                    else:
+                        del by_value[value]
+            self._user_at[slot] = None
+            self._free_slots.append(slot)
+
+    def match(self, material, city):
+        """
+        Возвращает отсортированный список user_id, не отключивших ни material,
+        ни его категорию, ни city, и чьи круги (если они есть) покрывают city.
+        Город не из таблицы координат круги не ограничивают.
+        """
+        key = city_key(city)
+        with self._lock:
+            bits = self._all & ~(self._bitmaps["material"].get(material, 0)
+                                 | self._bitmaps["category"].get(_category_of(material), 0)
+                                 | self._bitmaps["city"].get(city, 0))
+            if self._restricted and key in geo_index.titles:
+                bits &= ~(self._restricted & ~self._covering.get(key, 0))
+            return sorted(_select_bits(bits, self._user_at))
+
+    def memory_bytes(self):
+        """
+        Приблизительный объём битовых карт в байтах.
+        """
+        with self._lock:
+            maps = [self._all, self._restricted] + list(self._covering.values())
+            maps += [bits for by_value in self._bitmaps.values() for bits in by_value.values()]
+            return sum(bits.bit_length() // 8 + 1 for bits in maps)
+
+
+def create_index(backend="bitset"):
+    """
+    backend: "bitset" — BitsetIndex, "sets" — SubscriptionIndex.
+    """
+    if backend == "sets":
+        return SubscriptionIndex()
+    if backend == "bitset":
+        return BitsetIndex()
+    raise ValueError(f"Unknown matcher backend: {backend}")
@@ -0,0 +1,299 @@
+"""
+migrations.py
+Версионные миграции схемы bot.db. Применённые версии записываются в таблицу
+schema_version; run_migrations() вызывается при старте бота (index.start_bot)
+и веб-формы (server.py) после init_db() и применяет недостающие по порядку.
+
+Перестроить индексы на работающей базе:
+    python migrations.py --rebuild-indexes
+"""
+
+import argparse
+import logging
+import time
+
+import db
+
+logger = logging.getLogger(__name__)
+
+
+def _migrate_sparse_filters(cursor):
+    """
+    Переводит notification_filters со старой схемы (по строке на каждый
+    материал и город пользователя) на разреженную: включённые строки
+    совпадают с умолчанием и удаляются, из дубликатов отключённых
+    остаётся по одной строке.
+    """
+    cursor.execute("DELETE FROM notification_filters WHERE is_enabled != 0 OR is_enabled IS NULL")
+    cursor.execute('''
+        DELETE FROM notification_filters
+        WHERE id NOT IN (
+            SELECT MIN(id) FROM notification_filters
+            GROUP BY user_id, filter_type, value
+        )
+    ''')
+
+
+# Вторичные индексы: имя → определение. Используются и миграцией,
+# и перестройкой (rebuild_indexes).
+INDEXES = {
+    # get_notification_items, toggle_notification_item
+    "idx_filters_user_type":
+        "notification_filters(user_id, filter_type)",
+    # покрывающий индекс для подбора получателей запросом к БД
+    "idx_filters_type_value":
+        "notification_filters(filter_type, value, is_enabled, user_id)",
+    # листинг заявок по дате
+    "idx_requests_created":
+        "requests(created_at)",
+    # листинг заказов Scraptraffic по дате
+    "idx_orders_date":
+        "orders(date, order_id)",
+    # выборка готовых к отправке сообщений очереди outbox: Pro раньше free
+    "idx_outbox_claim":
+        "outbox(status, priority, due_at)",
+    # заявки, собранные в дайджест
+    "idx_outbox_items_outbox":
+        "outbox_items(outbox_id)",
+    # вытеснение устаревших ключей принятых заказов
+    "idx_seen_orders_at":
+        "seen_orders(seen_at)",
+}
+
+
+def _create_indexes(*names):
+    def apply(cursor):
+        for name in names:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {INDEXES[name]}")
+    return apply
+
+
+def _create_orders_search(cursor):
+    """
+    Локальная копия заказов Scraptraffic и полнотекстовый индекс FTS5 по ней.
+    Токенизатор trigram ищет по любой подстроке от трёх символов
+    (в том числе внутри русских слов) без учёта регистра. Индекс внешнего
+    содержимого (content='orders') синхронизируется триггерами.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS orders (
+            order_id INTEGER PRIMARY KEY,
+            material TEXT,
+            quantity TEXT,
+            city TEXT,
+            comment TEXT,
+            date TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS orders_fts USING fts5(
+            material, quantity, city, comment,
+            content='orders', content_rowid='order_id', tokenize='trigram'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS orders_fts_insert AFTER INSERT ON orders BEGIN
+            INSERT INTO orders_fts (rowid, material, quantity, city, comment)
+            VALUES (new.order_id, new.material, new.quantity, new.city, new.comment);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS orders_fts_delete AFTER DELETE ON orders BEGIN
+            INSERT INTO orders_fts (orders_fts, rowid, material, quantity, city, comment)
+            VALUES ('delete', old.order_id, old.material, old.quantity, old.city, old.comment);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS orders_fts_update AFTER UPDATE ON orders BEGIN
+            INSERT INTO orders_fts (orders_fts, rowid, material, quantity, city, comment)
+            VALUES ('delete', old.order_id, old.material, old.quantity, old.city, old.comment);
+            INSERT INTO orders_fts (rowid, material, quantity, city, comment)
+            VALUES (new.order_id, new.material, new.quantity, new.city, new.comment);
+        END
+    ''')
+    _create_indexes("idx_orders_date")(cursor)
+
+
+def _add_orders_search_key(cursor):
+    """
+    Колонка search_key: поля заказа в нижнем регистре, заранее
+    (orders.make_search_key). Поиск коротких запросов идёт по ней
+    и не вызывает casefold на каждой строке.
+    """
+    cursor.execute("ALTER TABLE orders ADD COLUMN search_key TEXT")
+    cursor.execute('''
+        UPDATE orders
+        SET search_key = casefold(material || ' ' || quantity || ' ' || city || ' ' || comment || ' ' || order_id)
+    ''')
+
+
+def _create_outbox(cursor):
+    """
+    Очередь исходящих уведомлений. Рассылка сначала записывается сюда,
+    затем outbox.OutboxWorker отправляет её, так что перезапуск процесса
+    посреди рассылки ничего не теряет. status: pending → sending →
+    sent / failed; due_at — unix-время, раньше которого строку не брать
+    (отложенный повтор).
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            due_at REAL NOT NULL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, due_at)")
+
+
+def _add_outbox_priority(cursor):
+    """
+    Приоритет доставки: 0 — Pro (сразу), 1 — бесплатный аккаунт (с задержкой).
+    Готовые к отправке сообщения забираются по (priority, due_at), так что
+    при всплеске лимит Telegram в первую очередь тратится на Pro.
+    """
+    cursor.execute("ALTER TABLE outbox ADD COLUMN priority INTEGER NOT NULL DEFAULT 1")
+    cursor.execute("DROP INDEX IF EXISTS idx_outbox_due")
+    _create_indexes("idx_outbox_claim")(cursor)
+
+
+def _create_outbox_digests(cursor):
+    """
+    Дайджесты: сообщение outbox с digest=1 собирает заявки пользователя
+    (outbox_items) до наступления due_at и уходит одним сообщением.
+    Уникальный частичный индекс гарантирует не больше одного открытого
+    (ещё не бравшегося в отправку) дайджеста на пользователя; он нужен
+    для ON CONFLICT в db.enqueue_notifications и поэтому не входит в INDEXES.
+    """
+    cursor.execute("ALTER TABLE outbox ADD COLUMN digest INTEGER NOT NULL DEFAULT 0")
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_outbox_open_digest ON outbox(user_id)
+        WHERE status = 'pending' AND digest = 1 AND attempts = 0
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox_items (
+            id INTEGER PRIMARY KEY,
+            outbox_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            FOREIGN KEY(outbox_id) REFERENCES outbox(id)
+        )
+    ''')
+    _create_indexes("idx_outbox_items_outbox")(cursor)
+
+
+def _create_seen_orders(cursor):
+    """
+    Ключи недавно принятых заказов (db.remember_order_keys): повтор того же
+    заказа от Scraptraffic подтверждается без подбора получателей и рассылки.
+    id растёт с каждой вставкой, по нему отсекаются самые старые ключи.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS seen_orders (
+            id INTEGER PRIMARY KEY,
+            key TEXT NOT NULL UNIQUE,
+            seen_at REAL NOT NULL
+        )
+    ''')
+    _create_indexes("idx_seen_orders_at")(cursor)
+
+
+# (версия, название, функция(cursor)). Новые миграции — только в конец списка.
+MIGRATIONS = [
+    (1, "sparse notification_filters", _migrate_sparse_filters),
+    (2, "filters and requests indexes", _create_indexes(
+        "idx_filters_user_type", "idx_filters_type_value", "idx_requests_created")),
+    (3, "orders mirror with FTS5 search", _create_orders_search),
+    (4, "precomputed orders search key", _add_orders_search_key),
+    (5, "notifications outbox", _create_outbox),
+    (6, "outbox delivery priority", _add_outbox_priority),
+    (7, "outbox digests", _create_outbox_digests),
+    (8, "seen orders for idempotent ingestion", _create_seen_orders),
+]
+
+
+def _ensure_version_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+
+def current_version():
+    conn = db.get_connection()
+    _ensure_version_table(conn)
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def run_migrations():
+    """
+    Применяет все ещё не применённые миграции, каждую в своей транзакции.
+    BEGIN IMMEDIATE берёт блокировку записи до проверки версии, поэтому бот
+    и server.py, стартующие одновременно, не применят одну миграцию дважды.
+    Возвращает список применённых версий.
+    """
+    conn = db.get_connection()
+    _ensure_version_table(conn)
+    applied = []
+    for version, name, apply in MIGRATIONS:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            done = conn.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone()
+            if not done:
+                logger.info("Applying migration %s: %s", version, name)
+                cursor = conn.cursor()
+                apply(cursor)
+                cursor.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (version, name))
+                applied.append(version)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return applied
+
+
+def rebuild_indexes(names=None, pause=0.5):
+    """
+    Перестраивает индексы по одному, каждый в короткой отдельной транзакции.
+    В режиме WAL читатели не блокируются вовсе, а запись бота ждёт
+    (busy_timeout) только пока перестраивается один индекс; пауза между
+    индексами даёт накопившимся записям пройти.
+    """
+    conn = db.get_connection()
+    for i, name in enumerate(names or INDEXES):
+        if i:
+            time.sleep(pause)
+        started = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(f"DROP INDEX IF EXISTS {name}")
+            conn.execute(f"CREATE INDEX {name} ON {INDEXES[name]}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        logger.info("Rebuilt index %s in %.1f ms", name, (time.perf_counter() - started) * 1000)
+    conn.execute("ANALYZE")
+    conn.commit()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Миграции схемы bot.db")
+    parser.add_argument("--rebuild-indexes", action="store_true", help="перестроить вторичные индексы")
+    args = parser.parse_args()
+    db.init_db()
+    run_migrations()
+    if args.rebuild_indexes:
+        rebuild_indexes()
+    print("schema version:", current_version())
@@ -0,0 +1,174 @@
+"""
+normalize.py
+Приведение названий материала и города из заказа к названиям каталога
+materials_and_cities. Фильтры уведомлений хранят точные названия каталога,
+а заказы приходят свободным текстом ("москва ", "г. Москва", "Санкт Петербург"),
+поэтому значения нормализуются один раз при приёме заказа
+(index.order_notification, handlers.notify_users_about_new_request),
+и подбор получателей остаётся точным поиском по словарю. Словарь
+свёрнутая форма → название строится из каталога при каждом его
+обновлении (catalog.CatalogCache).
+"""
+
+import re
+
+# Приставки перед названием города, отбрасываются после свёртки;
+# "город" — только отдельным словом, чтобы не обрезать "Городец"
+CITY_PREFIXES = re.compile(r"^(?:город\s|гор\.|г\.|г\s)\s*")
+
+# Распространённые сокращения: свёрнутая форма → название в каталоге.
+# Псевдоним используется, только если его название есть в каталоге.
+CITY_ALIASES = {
+    "мск": "Москва",
+    "спб": "Санкт-Петербург",
+    "питер": "Санкт-Петербург",
+    "екб": "Екатеринбург",
+    "нск": "Новосибирск",
+    "нн": "Нижний Новгород",
+}
+MATERIAL_ALIASES = {}
+
+_SEPARATORS = re.compile(r"[\s\-‐–—_]+")
+_CYRILLIC = re.compile(r"[а-я]")
+# латинские буквы, неотличимые от кириллических, в русском тексте
+_HOMOGLYPHS = str.maketrans("aceopxykmtbh", "асеорхукмтвн")
+
+
+def fold(text):
+    """
+    Свёрнутая форма строки: casefold, ё → е, латинские двойники букв
+    в кириллическом тексте, дефисы и пробелы — один пробел, без кавычек
+    и точек по краям.
+    """
+    text = str(text).casefold().replace("ё", "е")
+    if _CYRILLIC.search(text):
+        text = text.translate(_HOMOGLYPHS)
+    return _SEPARATORS.sub(" ", text).strip(" .,;:'\"«»")
+
+
+def _deletes(key, depth):
+    """
+    Все строки, которые получаются из key удалением не больше depth символов
+    (включая сам key).
+    """
+    found = frontier = {key}
+    for _ in range(depth):
+        frontier = {word[:i] + word[i + 1:] for word in frontier for i in range(len(word))}
+        found = found | frontier
+    return found
+
+
+def _within(a, b, limit):
+    """
+    Расстояние Левенштейна между a и b, если оно не больше limit, иначе None.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        current = [i]
+        for j, char_b in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= limit else None
+
+
+class Normalizer:
+    """
+    Нормализатор одного списка названий. canonical() возвращает название
+    каталога или исходную строку без лишних пробелов, если сопоставить
+    не удалось. Опечатки исправляются, только если ближайшее название
+    единственное; результаты поиска по опечаткам кэшируются.
+
+    Для опечаток при построении заводится индекс удалений (как в SymSpell):
+    строки, получаемые из ключей каталога удалением до двух символов. Если
+    две строки отличаются не больше чем на d правок, удаление не больше d
+    символов из каждой даёт общую строку, поэтому кандидаты находятся
+    поиском удалений запроса в словаре, и расстояние считается только до них,
+    а не до всего каталога.
+    """
+
+    def __init__(self, titles, aliases=None, prefixes=None, cache_size=10000):
+        self.prefixes = prefixes
+        self.cache_size = cache_size
+        self._lookup = {}
+        for title in titles:
+            self._lookup.setdefault(self._key(title), title)
+        for alias, title in (aliases or {}).items():
+            title = self._lookup.get(self._key(title))
+            if title is not None:
+                self._lookup.setdefault(self._key(alias), title)
+        self._deletions = {}
+        for key in self._lookup:
+            # ключ длины n сравнивается с запросами длины до n + 2
+            for variant in _deletes(key, self._max_distance(len(key) + 2)):
+                self._deletions.setdefault(variant, []).append(key)
+        self._fuzzy = {}
+
+    def _key(self, text):
+        key = fold(text)
+        if self.prefixes is not None:
+            key = self.prefixes.sub("", key)
+        return key
+
+    @staticmethod
+    def _max_distance(length):
+        if length <= 4:
+            return 0
+        return 1 if length <= 8 else 2
+
+    def _closest(self, key):
+        limit = self._max_distance(len(key))
+        if not limit:
+            return None
+        candidates = set()
+        for variant in _deletes(key, limit):
+            candidates.update(self._deletions.get(variant, ()))
+        best, best_distance, ambiguous = None, limit + 1, False
+        for candidate in candidates:
+            title = self._lookup[candidate]
+            distance = _within(key, candidate, min(limit, best_distance))
+            if distance is None:
+                continue
+            if distance < best_distance:
+                best, best_distance, ambiguous = title, distance, False
+            elif title != best:
+                ambiguous = True
+        return None if ambiguous else best
+
+    def canonical(self, text):
+        if not text:
+            return text
+        key = self._key(text)
+        title = self._lookup.get(key)
+        if title is not None:
+            return title
+        if key not in self._fuzzy:
+            if len(self._fuzzy) >= self.cache_size:
+                self._fuzzy.clear()
+            self._fuzzy[key] = self._closest(key)
+        title = self._fuzzy[key]
+        return title if title is not None else str(text).strip()
+
+    def __len__(self):
+        return len(self._lookup)
+
+
+class CatalogNormalizer:
+    """
+    Нормализаторы материалов и городов по каталогу {"materials": [...], "cities": [...]}.
+    """
+
+    def __init__(self, catalog=None):
+        catalog = catalog or {}
+        self.materials = Normalizer(catalog.get("materials", ()), MATERIAL_ALIASES)
+        self.cities = Normalizer(catalog.get("cities", ()), CITY_ALIASES, CITY_PREFIXES)
+
+    def material(self, text):
+        return self.materials.canonical(text)
+
+    def city(self, text):
+        return self.cities.canonical(text)
@@ -0,0 +1,103 @@
+"""
+order_sync.py
+Фоновая синхронизация локальной копии заказов Scraptraffic (таблица orders).
+Просмотр и поиск заявок в боте читают только локальную таблицу, поэтому
+никогда не ждут загрузки полного списка. Между полными сверками в базу
+пишутся только заказы новее отметки (max_date, max_order_id); новые заказы
+из вебхука /new_order (index.handle_new_order) попадают в таблицу сразу.
+Список заказов разбирается потоком и пишется пачками, так что память
+не растёт вместе с размером ответа.
+"""
+
+import asyncio
+import logging
+import time
+
+import upstream
+from config import ORDERS_SYNC_INTERVAL
+from db_async import get_orders_watermark, upsert_orders
+from orders import Order
+
+logger = logging.getLogger(__name__)
+
+
+# Сколько заказов разбирается до записи пачки в БД
+ORDERS_BATCH_SIZE = 1000
+
+
+async def iter_order_batches(batch_size=ORDERS_BATCH_SIZE):
+    """
+    Заказы из /orders (orders.Order) пачками по batch_size по мере разбора ответа.
+    """
+    batch = []
+    async for data in upstream.client.stream_json_array("orders"):
+        order = Order.from_api(data) if isinstance(data, dict) else None
+        if order is not None:
+            batch.append(order)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def newer_than(orders, watermark):
+    """
+    Заказы с order_id больше отметки или с датой не раньше последней известной.
+    """
+    max_date, max_id = watermark
+    return [order for order in orders if order.order_id > max_id or order.date >= max_date]
+
+
+class OrderSync:
+    """
+    Периодически забирает список заказов и переносит изменения в orders.
+    Каждый full_every-й проход — полная сверка: upsert всех заказов
+    (неизменившиеся строки не переписываются), чтобы подхватить правки старых.
+    """
+
+    def __init__(self, interval=ORDERS_SYNC_INTERVAL, full_every=60):
+        self.interval = interval
+        self.full_every = full_every
+        self.runs = 0
+        self.stats = {"runs": 0, "full": 0, "fetched": 0, "written": 0, "errors": 0, "last_sync": None}
+
+    async def sync_once(self, full=False):
+        """
+        Один проход синхронизации. Возвращает число записанных строк.
+        """
+        watermark = None if full else await get_orders_watermark()
+        fetched = written = 0
+        async for batch in iter_order_batches():
+            fetched += len(batch)
+            if watermark is not None:
+                batch = newer_than(batch, watermark)
+            if batch:
+                written += await upsert_orders(batch)
+        self.stats["runs"] += 1
+        self.stats["full"] += full
+        self.stats["fetched"] += fetched
+        self.stats["written"] += written
+        self.stats["last_sync"] = time.time()
+        return written
+
+    async def run(self):
+        """
+        Цикл фоновой задачи; первый проход — полная сверка при старте.
+        """
+        while True:
+            full = self.runs % self.full_every == 0
+            self.runs += 1
+            try:
+                written = await self.sync_once(full)
+                if written:
+                    logger.info("Order sync (%s): %s orders written", "full" if full else "delta", written)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error("Order sync failed: %s", e)
+            await asyncio.sleep(self.interval)
+
+
+worker = OrderSync()
@@ -0,0 +1,75 @@
+"""
+orders.py
+Компактная запись заказа Scraptraffic. Словарь из API превращается в Order
+сразу при разборе (order_sync.py, вебхук /new_order): лишние поля
+отбрасываются, повторяющиеся значения (материал, объём, город, дата)
+интернируются, а строка для поиска приводится к нижнему регистру один раз —
+при записи, а не при каждом поиске.
+"""
+
+import hashlib
+import sys
+
+
+def idempotency_key(data):
+    """
+    Ключ повторной доставки заказа из API: "id:<order_id>" или, если
+    order_id нет, хэш материала, объёма, города и комментария.
+    """
+    try:
+        return f"id:{int(data.get('order_id'))}"
+    except (TypeError, ValueError):
+        pass
+    content = "\x1f".join(str(data.get(field) or "").strip()
+                           for field in ("text_material", "text_volume", "text_city", "comment"))
+    return "sha1:" + hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def make_search_key(order_id, material, quantity, city, comment):
+    """
+    Строка поиска подстрокой: все поля заказа через пробел, casefold.
+    """
+    return f"{material} {quantity} {city} {comment} {order_id}".casefold()
+
+
+class Order:
+    """
+    Заказ: order_id, material, quantity, city, comment, date и search_key.
+    """
+
+    __slots__ = ("order_id", "material", "quantity", "city", "comment", "date", "search_key")
+
+    def __init__(self, order_id, material, quantity, city, comment, date, search_key=None):
+        self.order_id = order_id
+        self.material = sys.intern(material)
+        self.quantity = sys.intern(quantity)
+        self.city = sys.intern(city)
+        self.comment = comment
+        self.date = sys.intern(date)
+        self.search_key = search_key or make_search_key(order_id, material, quantity, city, comment)
+
+    @classmethod
+    def from_api(cls, data):
+        """
+        Заказ из словаря API (order_id, text_material, text_volume, text_city,
+        comment, date) или None, если order_id нет или он не число.
+        """
+        try:
+            order_id = int(data.get("order_id"))
+        except (TypeError, ValueError):
+            return None
+        return cls(
+            order_id,
+            str(data.get("text_material") or ""),
+            str(data.get("text_volume") or ""),
+            str(data.get("text_city") or ""),
+            str(data.get("comment") or ""),
+            str(data.get("date") or ""),
+        )
+
+    def as_row(self):
+        return (self.order_id, self.material, self.quantity, self.city,
+                self.comment, self.date, self.search_key)
+
+    def __repr__(self):
+        return f"Order({self.order_id}, {self.material!r}, {self.city!r}, {self.date!r})"
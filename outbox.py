@@ -0,0 +1,201 @@
+"""
+outbox.py
+Доставка уведомлений из очереди outbox (см. migrations._create_outbox).
+Вебхук /new_order и создание заявки в боте только ставят сообщения
+в очередь (db.enqueue_notifications), а несколько воркеров забирают их
+пачками, отправляют через dispatcher и записывают итог. Сообщения Pro
+становятся готовыми сразу, бесплатных аккаунтов — через DELIVERY_DELAYS
+(db.delivery_tier), и из готовых Pro забираются первыми. Заявки для
+аккаунтов с окном DIGEST_WINDOWS копятся в дайджесте и уходят одним
+сообщением (при длинном списке — несколькими страницами). Временные ошибки
+откладываются с экспоненциальной задержкой; после max_attempts сообщение
+помечается failed. Старые доставленные и неотправленные записи
+удаляются раз в purge_interval секунд.
+"""
+
+import asyncio
+import html
+import logging
+import time
+
+from db_async import claim_outbox, finish_outbox, purge_outbox, requeue_claimed_outbox
+from dispatcher import FAILED, RETRY, SENT, dispatcher
+
+logger = logging.getLogger(__name__)
+
+# Ограничение Telegram на длину одного сообщения
+MESSAGE_LIMIT = 4096
+
+# Наибольшая длина полей строки дайджеста после экранирования: название,
+# количество, город и подробности. Строка заведомо помещается на страницу,
+# и render_digest не приходится резать готовую разметку.
+DIGEST_FIELD_LIMITS = (200, 100, 200, 1000)
+
+
+def clip_html(text, limit):
+    """
+    text, экранированный для parse_mode HTML и не длиннее limit символов;
+    обрезается исходный текст, так что сущности (&lt; и т.п.) не разрываются.
+    """
+    text = html.escape(str(text), quote=False)
+    if len(text) <= limit:
+        return text
+    cut = limit - 1
+    # не оставляем обрывок сущности вроде "&am"
+    amp = text.rfind("&", max(0, cut - 5), cut)
+    if amp != -1 and text.find(";", amp, cut) == -1:
+        cut = amp
+    return text[:cut] + "…"
+
+
+def digest_item(material, quantity, city, details):
+    """
+    Строка дайджеста для одной заявки: поля из заказа экранируются
+    и обрезаются до добавления разметки.
+    """
+    material, quantity, city, details = (
+        clip_html(value, limit) for value, limit in zip((material, quantity, city, details), DIGEST_FIELD_LIMITS)
+    )
+    return f"• <b>{material}</b>, {quantity}, {city}\n  {details}"
+
+
+def render_digest(items, limit=MESSAGE_LIMIT):
+    """
+    Тексты сообщений дайджеста: заголовок с числом заявок и строки items
+    (digest_item), разбитые на страницы не длиннее limit символов.
+    """
+    footer = "\n\nДля просмотра откройте меню бота."
+    budget = limit - len(footer) - 64  # запас под заголовок страницы
+    pages, page, size = [], [], 0
+    for item in items:
+        if page and size + len(item) + 2 > budget:
+            pages.append(page)
+            page, size = [], 0
+        page.append(item)
+        size += len(item) + 2
+    if page:
+        pages.append(page)
+    texts = []
+    for number, page in enumerate(pages, start=1):
+        header = f"🔔 <b>Новые заявки: {len(items)}</b>"
+        if len(pages) > 1:
+            header += f" ({number}/{len(pages)})"
+        texts.append(header + "\n\n" + "\n\n".join(page) + footer)
+    return texts
+
+
+class OutboxWorker:
+    """
+    Пул из workers задач, каждая берёт до batch_size сообщений за раз.
+    Пустая очередь опрашивается раз в poll_interval секунд;
+    wake() будит воркеры сразу после постановки новых сообщений.
+    """
+
+    def __init__(self, workers=4, batch_size=50, poll_interval=1.0,
+                 max_attempts=8, backoff=5.0, max_backoff=3600.0, purge_interval=3600.0):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.purge_interval = purge_interval
+        self._wakeup = None
+        self.stats = {"claimed": 0, "sent": 0, "retried": 0, "failed": 0,
+                      "digests": 0, "digest_items": 0, "errors": 0, "purged": 0}
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _retry_delay(self, attempts):
+        return min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+
+    async def _deliver(self, bot, chat_id, text, parse_mode, items):
+        """
+        Отправляет обычное сообщение или все страницы дайджеста.
+        При повторе дайджест отправляется заново целиком.
+        """
+        if items is None:
+            return await dispatcher.send(bot, chat_id, text, parse_mode=parse_mode)
+        for page in render_digest(items):
+            status, error = await dispatcher.send(bot, chat_id, page, parse_mode=parse_mode)
+            if status != SENT:
+                return status, error
+        self.stats["digests"] += 1
+        self.stats["digest_items"] += len(items)
+        return SENT, None
+
+    async def process_batch(self, bot):
+        """
+        Забирает и отправляет одну пачку. Возвращает её размер.
+        """
+        batch = await claim_outbox(self.batch_size)
+        if not batch:
+            return 0
+        self.stats["claimed"] += len(batch)
+        # исключение одной отправки не должно оставить всю пачку в 'sending'
+        results = await asyncio.gather(*[
+            self._deliver(bot, chat_id, text, parse_mode, items)
+            for _id, chat_id, text, parse_mode, _attempts, items in batch
+        ], return_exceptions=True)
+        sent, retries, failed = [], [], []
+        now = time.time()
+        for (msg_id, chat_id, _text, _mode, attempts, _items), result in zip(batch, results):
+            if isinstance(result, Exception):
+                logger.error("Outbox: unexpected error sending %s to %s: %r", msg_id, chat_id, result)
+                self.stats["errors"] += 1
+                result = (RETRY, repr(result))
+            elif isinstance(result, BaseException):
+                raise result
+            status, error = result
+            if status == SENT:
+                sent.append(msg_id)
+            elif status == FAILED or attempts >= self.max_attempts:
+                failed.append((msg_id, error))
+            else:
+                retries.append((msg_id, now + self._retry_delay(attempts), error))
+        await finish_outbox(sent, retries, failed)
+        self.stats["sent"] += len(sent)
+        self.stats["retried"] += len(retries)
+        self.stats["failed"] += len(failed)
+        return len(batch)
+
+    async def _loop(self, bot):
+        while True:
+            try:
+                if await self.process_batch(bot):
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Outbox worker error: %s", e)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _purge_loop(self):
+        while True:
+            try:
+                self.stats["purged"] += await purge_outbox()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Outbox purge error: %s", e)
+            await asyncio.sleep(self.purge_interval)
+
+    async def run(self, bot):
+        """
+        Фоновая задача: возвращает в очередь недоставленное до прошлой
+        остановки, запускает воркеры и периодическую чистку старых записей.
+        """
+        self._wakeup = asyncio.Event()
+        requeued = await requeue_claimed_outbox()
+        if requeued:
+            logger.info("Outbox: %s messages requeued after restart", requeued)
+        await asyncio.gather(self._purge_loop(), *[self._loop(bot) for _ in range(self.workers)])
+
+
+worker = OutboxWorker()
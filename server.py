@@ -1,12 +1,21 @@
 # server.py
 import os
 from flask import Flask, request, render_template
-from db import init_db, add_request
+from db import init_db, add_request, close_thread_connection
+from migrations import run_migrations
 
 app = Flask(__name__)
 
 # 1) Initialize DB on startup (optional, ensures the tables exist)
 init_db()
+run_migrations()
+
+@app.teardown_appcontext
+def close_db_connection(exception=None):
+    """
+    Each request runs in its own thread: release its SQLite connection.
+    """
+    close_thread_connection()
 
 @app.route("/")
 def index():
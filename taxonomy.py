@@ -0,0 +1,62 @@
+"""
+taxonomy.py
+Категории материалов — те же группы, что чат-группы в handlers.CHANNEL_LINKS.
+Пользователь может отключить категорию целиком одной строкой фильтра
+(filter_type 'category'), а не каждый её материал по отдельности.
+Категория материала зависит только от его названия (category_of): индекс
+подписок (matcher.py) запоминает её для каждого материала, так что подбор
+получателей остаётся поиском по словарю и не ждёт загрузки каталога.
+"""
+
+import re
+
+from normalize import fold
+
+# (ключ, название, начала слов в свёрнутой форме). Порядок важен: материал
+# относится к первой подходящей категории, базовые — последние как самые общие.
+CATEGORIES = [
+    ("precious", "💎 Драгоценные металлы",
+     ("золот", "серебр", "платин", "паллади", "роди", "ириди", "рутени", "осми", "драгоцен")),
+    ("rare_earth", "🧲 Редкоземельные металлы",
+     ("неоди", "диспрози", "лантан", "цери", "иттри", "самари", "празеоди", "гадолини",
+      "терби", "европи", "эрби", "редкоземел", "магнит")),
+    ("new_energy", "⚡ Новая энергия",
+     ("лити", "кобальт", "аккумулятор", "акб", "батаре", "солнечн", "катод")),
+    ("minor", "🔩 Редкие материалы",
+     ("вольфрам", "молибден", "титан", "тантал", "ниоби", "ванади", "висмут", "сурьм",
+      "инди", "галли", "германи", "циркони", "хром", "магни", "кадми", "селен", "теллур",
+      "рени", "гафни", "бериллий", "редк")),
+    ("synthetic", "⚗️ Синтетические отходы",
+     ("пластик", "пластмасс", "полиэтилен", "полипропилен", "полимер", "пэт", "пнд", "пвд",
+      "пвх", "пленк", "резин", "шин", "каучук", "пенопласт", "синтет")),
+    ("base", "📦 Базовые материалы",
+     ("мед", "алюмин", "латун", "бронз", "свин", "цинк", "никел", "олов", "нерж", "стал",
+      "чугун", "черн", "цветн", "желез", "металлолом", "лом", "кабел", "провод")),
+]
+
+CATEGORY_TITLES = {key: title for key, title, _stems in CATEGORIES}
+
+_WORDS = re.compile(r"\w+")
+
+
+def category_of(material):
+    """
+    Ключ категории материала или None, если материал ни к одной не относится.
+    """
+    words = _WORDS.findall(fold(material))
+    for key, _title, stems in CATEGORIES:
+        if any(word.startswith(stems) for word in words):
+            return key
+    return None
+
+
+def classify(materials):
+    """
+    {название материала: ключ категории} для материалов каталога, у которых категория нашлась.
+    """
+    categories = {}
+    for material in materials:
+        key = category_of(material)
+        if key is not None:
+            categories[material] = key
+    return categories
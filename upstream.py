@@ -0,0 +1,196 @@
+"""
+upstream.py
+HTTP-клиент API Scraptraffic. Одна ClientSession на всё приложение держит
+keep-alive соединения, так что нажатие кнопки в боте не платит за новый
+TCP+TLS handshake. Сессия создаётся в index.start_bot / start_webserver
+(или лениво при первом запросе) и закрывается при остановке.
+"""
+
+import codecs
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+
+import aiohttp
+
+from config import BEARER_TOKEN
+
+logger = logging.getLogger(__name__)
+
+API_BASE = "https://scraptraffic.com/api/telegram_bot_external"
+
+
+class EndpointStats:
+    """
+    Счётчики одного эндпоинта: число запросов в сеть, ошибок и время ответа.
+    """
+
+    __slots__ = ("requests", "errors", "total_ms", "max_ms")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, elapsed_ms, failed):
+        self.requests += 1
+        self.errors += failed
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "avg_ms": round(self.total_ms / self.requests, 2) if self.requests else 0.0,
+            "max_ms": round(self.max_ms, 2),
+        }
+
+
+_decoder = json.JSONDecoder()
+
+_WHITESPACE = " \t\r\n"
+
+
+async def iter_json_array(chunks):
+    """
+    Разбирает JSON-массив из асинхронного потока байтов и по одному отдаёт
+    его элементы; в памяти держится только недоразобранный хвост.
+    Неверный JSON (в том числе пропущенная, лишняя или висящая запятая)
+    даёт ValueError.
+    """
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    # чего ждём дальше: "[" — начала массива, "first" — первого элемента
+    # или "]", "value" — элемента после запятой, "sep" — запятой или "]"
+    expect = "["
+    finished = eof = False
+    chunks = chunks.__aiter__()
+    while not eof:
+        try:
+            chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            chunk, eof = b"", True
+        buf += utf8.decode(chunk, final=eof)
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+            if pos == len(buf) or finished:
+                break
+            char = buf[pos]
+            if expect == "[":
+                if char != "[":
+                    raise ValueError("JSON array expected")
+                expect = "first"
+                pos += 1
+                continue
+            if expect == "sep":
+                if char == ",":
+                    expect = "value"
+                elif char == "]":
+                    finished = True
+                else:
+                    raise ValueError(f"Expected ',' or ']' at char {pos}")
+                pos += 1
+                continue
+            if char == "]" and expect == "first":
+                finished = True
+                pos += 1
+                continue
+            if char in ",]":
+                raise ValueError(f"Expected value at char {pos}")
+            try:
+                item, end = _decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                break
+            if not eof and (end == len(buf) or buf[end] not in _WHITESPACE + ",]"):
+                # элемент должен закончиться разделителем: число на границе
+                # куска ("-1.5" из "-1.5e3") может продолжиться в следующем
+                break
+            pos = end
+            expect = "sep"
+            yield item
+        buf = buf[pos:]
+        if finished and buf.strip():
+            raise ValueError("Unexpected data after JSON array")
+    if not finished:
+        raise ValueError("Unterminated JSON array")
+
+
+class UpstreamClient:
+    """
+    Пул соединений к API Scraptraffic с ограничениями, кэшем DNS,
+    явными таймаутами и метриками по эндпоинтам.
+    """
+
+    def __init__(self, base_url=API_BASE, token=BEARER_TOKEN, *,
+                 limit=100, limit_per_host=20, dns_ttl=300, keepalive_timeout=30,
+                 timeout=aiohttp.ClientTimeout(total=30, connect=5, sock_read=20)):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self._session = None
+        self.stats = {}
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers={"Authorization": f"Bearer {self.token}"},
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    @asynccontextmanager
+    async def request(self, method, endpoint, **kwargs):
+        """
+        Выполняет запрос к {base_url}/{endpoint} и отдаёт ответ внутри контекста;
+        время до выхода из контекста (включая чтение тела) попадает в метрики.
+        """
+        session = await self.start()
+        stats = self.stats.setdefault(endpoint, EndpointStats())
+        started = time.perf_counter()
+        failed = True
+        try:
+            async with session.request(method, f"{self.base_url}/{endpoint}", **kwargs) as resp:
+                yield resp
+                failed = resp.status >= 400
+        finally:
+            stats.observe((time.perf_counter() - started) * 1000, failed)
+
+    async def stream_json_array(self, endpoint, chunk_size=65536, **kwargs):
+        """
+        GET эндпоинта, отдающего JSON-массив: элементы разбираются по мере
+        прихода тела ответа, весь документ в памяти не собирается.
+        """
+        async with self.request("GET", endpoint, **kwargs) as resp:
+            resp.raise_for_status()
+            async for item in iter_json_array(resp.content.iter_chunked(chunk_size)):
+                yield item
+
+    def metrics(self):
+        return {endpoint: stats.as_dict() for endpoint, stats in self.stats.items()}
+
+
+# Клиент приложения; используется handlers.py и index.py.
+client = UpstreamClient()